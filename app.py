@@ -1,18 +1,24 @@
+import atexit
+import os
 from datetime import datetime
+from io import BytesIO
 from time import perf_counter
 from uuid import uuid4
 
-import PIL
-from flask import Flask, request
+from flask import Flask, request, send_file
 from flask.json import jsonify
 from flask_cors import CORS, cross_origin
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 
+from bulk import generate_games, merge_sheets, warm_up_generation
 from coffeegame import CoffeeGame
+from exceptions import PlacementException, QueueFullException
+from games import GameStore
+from jobs import WARMUP_IMAGE, JobQueue, process_image
+from storage import BackgroundWriter, LocalStorage
 
 import matplotlib
-from matplotlib import pyplot as plt
 matplotlib.use('Agg')
 
 
@@ -41,6 +47,22 @@ migrate = Migrate(app, db)
 # url = "http://localhost:5000"
 url = 'coffee-game.ai'
 app.config['CORS_HEADERS'] = 'Content-Type'
+app.config['PROCESSING_WORKERS'] = int(os.environ.get('PROCESSING_WORKERS', os.cpu_count()))
+app.config['PROCESSING_QUEUE_SIZE'] = int(os.environ.get('PROCESSING_QUEUE_SIZE', 4 * app.config['PROCESSING_WORKERS']))
+
+app.config['PROCESSING_PREFORK'] = os.environ.get('PROCESSING_PREFORK', '0') == '1'
+app.config['GAME_STORE_DIR'] = os.environ.get('GAME_STORE_DIR', 'games')
+app.config['GENERATION_WORKERS'] = int(os.environ.get('GENERATION_WORKERS', os.cpu_count()))
+app.config['STORAGE_DIR'] = os.environ.get('STORAGE_DIR', 'storage')
+app.config['OVERLAY_TTL'] = int(os.environ.get('OVERLAY_TTL', 24 * 3600))
+app.config['STORAGE_GC_INTERVAL'] = int(os.environ.get('STORAGE_GC_INTERVAL', 3600))
+app.config['WRITER_THREADS'] = int(os.environ.get('WRITER_THREADS', 2))
+app.config['WRITER_QUEUE_SIZE'] = int(os.environ.get('WRITER_QUEUE_SIZE', 32))
+app.config['OVERLAY_WAIT'] = float(os.environ.get('OVERLAY_WAIT', 10))
+
+game_store = GameStore(app.config['GAME_STORE_DIR'])
+
+storage = LocalStorage(app.config['STORAGE_DIR'])
 
 
 class Game(db.Model):
@@ -64,11 +86,78 @@ class Image(db.Model):
     config = db.Column(db.JSON)
 
 
+def load_roster(uuid):
+    """
+    Player names of the game, None if the game is unknown.
+    """
+    try:
+        with app.app_context():
+            game = Game.query.filter_by(uuid=uuid).first()
+    except Exception as e:
+        print(f"Can't load the players of {uuid}: {e}")
+        return None
+
+    return game.players if game is not None else None
+
+
+def insert_images(rows):
+    """
+    Inserts the ``Image`` rows of the uploads, ``rows`` are dictionaries with the
+    game uuid, the image key and the config. Uploads of unknown games are skipped.
+    """
+    with app.app_context():
+        games = dict(db.session.query(Game.uuid, Game.id).filter(Game.uuid.in_({row['uuid'] for row in rows})))
+        db.session.add_all([Image(game_id=games[row['uuid']], image=row['image'], config=row['config'])
+                            for row in rows if row['uuid'] in games])
+        db.session.commit()
+
+
+def dispose_engine():
+    """
+    Initializer of the worker processes: the pooled database connections inherited
+    from the parent are dropped without closing them, so a worker never shares a
+    socket with the parent and opens its own connections.
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+job_queue = JobQueue(workers=app.config['PROCESSING_WORKERS'], max_pending=app.config['PROCESSING_QUEUE_SIZE'],
+                     initializer=dispose_engine)
+# the workers are forked before the app starts any thread of its own
+job_queue.start(WARMUP_IMAGE if app.config['PROCESSING_PREFORK'] else None)
+
+# started after the processing pool has its threads, so its workers come from a fork server and warm
+# up on their own
+generation_pool = JobQueue(workers=app.config['GENERATION_WORKERS'], initializer=warm_up_generation,
+                           start_method='forkserver')
+generation_pool.start(None)
+
+storage.start_collector('overlays', ttl=app.config['OVERLAY_TTL'], interval=app.config['STORAGE_GC_INTERVAL'])
+
+writer = BackgroundWriter(storage, insert_images, workers=app.config['WRITER_THREADS'],
+                          max_pending=app.config['WRITER_QUEUE_SIZE'])
+atexit.register(writer.shutdown)
+
+
+def write_overlay(key, render):
+    try:
+        storage.put(render(), 'overlays', key=key)
+    finally:
+        # a failed overlay is not waited for
+        storage.release(key)
+
+
 @app.route("/")
 def index():
     return app.send_static_file('index.html')
 
 
+def upload_extension(file):
+    extension = os.path.splitext(file.filename or '')[1].lower()
+    return extension if extension in ('.jpg', '.jpeg', '.png', '.heic', '.webp') else '.jpg'
+
+
 @app.route("/create_game", methods=['POST'])
 @cross_origin()
 def create_game():
@@ -79,15 +168,22 @@ def create_game():
     grid_size = request_json.get('grid_size', 5)
 
     uuid = uuid4().hex
-    cg = CoffeeGame(
-        players=players,
-        random_state=random_state,
-        orientation=orientation,
-        grid_size=grid_size,
-        uuid=uuid,
-        url=url
-    )
-    cg.generate_game_field(f"static/pdf/{uuid}.pdf")
+    try:
+        cg = CoffeeGame(
+            players=players,
+            random_state=random_state,
+            orientation=orientation,
+            grid_size=grid_size,
+            uuid=uuid,
+            url=url
+        )
+    except PlacementException as e:
+        return jsonify({
+            "error": "true",
+            "message": str(e)
+        })
+
+    pdf = storage.put(cg.render_game_field(), 'pdf', '.pdf')
 
     game = Game(
         players=players,
@@ -95,7 +191,7 @@ def create_game():
         orientation=orientation,
         grid_size=grid_size,
         uuid=uuid,
-        pdf=f"{uuid}.pdf"
+        pdf=pdf
     )
 
     db.session.add(game)
@@ -103,11 +199,52 @@ def create_game():
 
     return jsonify({
         "id": game.id,
-        "url": f"{url}/static/pdf/{game.pdf}",
+        "url": f"{url}/files/{game.pdf}",
         "date": game.date
     })
 
 
+@app.route("/create_games", methods=['POST'])
+@cross_origin()
+def create_games():
+    request_json = request.get_json()
+    games = request_json.get("games", [])
+    merge = request_json.get("merge", False)
+
+    with catchtime('Generating sheets'):
+        results, speed = generate_games(games, url, storage, generation_pool.executor,
+                                        app.config['GENERATION_WORKERS'])
+    print(f"    {len(games)} sheets, {speed:.1f} sheets/s")
+
+    created = [Game(**result) for result in results if "error" not in result]
+    db.session.add_all(created)
+    db.session.commit()
+
+    response = {
+        "games": [],
+        "sheets_per_second": speed
+    }
+
+    created = iter(created)
+    for result in results:
+        if "error" in result:
+            response["games"].append(result)
+        else:
+            game = next(created)
+            response["games"].append({
+                "id": game.id,
+                "url": f"{url}/files/{game.pdf}",
+                "date": game.date
+            })
+
+    if merge:
+        merged = BytesIO()
+        merge_sheets([storage.path(result['pdf']) for result in results if "error" not in result], merged)
+        response["pdf"] = f"{url}/files/{storage.put(merged.getvalue(), 'pdf', '.pdf')}"
+
+    return jsonify(response)
+
+
 @app.route("/upload_image", methods=['POST'])
 @cross_origin()
 def upload_image():
@@ -121,10 +258,14 @@ def upload_image():
             "message": "file not attached"
         })
 
+    data = file.read()
+
     try:
         cg = CoffeeGame()
         with catchtime('Image processing'):
-            detection_stages = cg.proceed_image(file.stream)
+            detection_stages = cg.proceed_image(BytesIO(data), store=game_store, roster=load_roster)
+        for name, stage_time in detection_stages.timings.items():
+            print(f"    {stage_time:.2f}s - {name}")
     except Exception as e:
         print(str(e))
         return jsonify({
@@ -144,8 +285,6 @@ def upload_image():
 
     stats = cg.get_number_of_cups()
     state_path = f"static/tmp/states/{uuid4().hex}.jpg"
-    overlay_path = f"static/tmp/states/{uuid4().hex}_overlay.jpg"
-    image_path = f"static/images/{uuid4().hex}.jpg"
 
 
     # Do not save to save time
@@ -153,30 +292,91 @@ def upload_image():
     # with catchtime('Saving current state'):
     #     cg.draw_current_state(save=state_path)
 
-    with catchtime('Ploting overlay'):
-        fig_overlay = detection_stages.plot_image_overlay()
-    with catchtime('Saving overlay'):
-        fig_overlay.savefig(overlay_path, bbox_inches='tight', pad_inches=0.0, dpi=100)
-
-        fig_overlay.clf()
-        plt.close()
-        del fig_overlay
-        import gc
-        gc.collect()
-        
-    with catchtime('Saving initial image'):
-        PIL.Image.open(file.stream).save(image_path)
-
-    # image_entry = Image(
-    #     game=game,
-    #     image=image_path.split("/")[-1],
-    #     config=cg.config
-    # )
-
-    # db.session.add(image_entry)
-    # db.session.commit()
+    # the overlay and the photo are persisted after the response, the overlay url
+    # is valid right away (GET /files waits while the key is pending)
+    overlay_key = storage.reserve_key('overlays', '.jpg')
+    # only the output-sized image is kept until the overlay is written
+    writer.submit(overlay_key, write_overlay, overlay_key, detection_stages.overlay_renderer())
+
+    # identical uploads are stored once
+    image_key = storage.make_key(data, 'images', upload_extension(file))
+    writer.put(image_key, data, row={
+        "uuid": uuid,
+        "image": image_key,
+        "config": cg.export_config()
+    })
+
     return jsonify({
         "statistics": stats,
+        "violations": cg.get_violations(),
+        "delta": cg.get_delta(),
         # "state_image": f"{url}/{state_path}",
-        "overlay_image": f"{overlay_path[6:]}"
+        "overlay_image": f"/files/{overlay_key}"
     })
+
+
+@app.route("/upload_image_async", methods=['POST'])
+@cross_origin()
+def upload_image_async():
+    file = None
+    for f in request.files:
+        file = request.files[f]
+
+    if file is None:
+        return jsonify({
+            "error": "true",
+            "message": "file not attached"
+        })
+
+    image_key = storage.put(file.read(), 'images', upload_extension(file))
+
+    try:
+        job_id = job_queue.submit(process_image, image_key, storage, game_store, load_roster, insert_images)
+    except QueueFullException as e:
+        return jsonify({
+            "error": "true",
+            "message": str(e)
+        }), 503
+
+    return jsonify({
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}"
+    })
+
+
+@app.route("/files/<path:key>", methods=['GET'])
+@cross_origin()
+def get_file(key):
+    if storage.is_pending(key):
+        # the overlay url is returned before the overlay is written, by this process
+        # or by another one
+        start = perf_counter()
+        writer.wait(key, timeout=app.config['OVERLAY_WAIT'])
+        storage.wait(key, timeout=max(app.config['OVERLAY_WAIT'] - (perf_counter() - start), 0))
+
+    path = storage.path(key)
+    if path is None or not os.path.exists(path):
+        return jsonify({
+            "error": "true",
+            "message": "File not found"
+        }), 404
+
+    # content addressed files never change
+    response = send_file(os.path.abspath(path), etag=storage.etag(key), max_age=365 * 24 * 3600, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+@cross_origin()
+def job_status(job_id):
+    status = job_queue.status(job_id)
+
+    if status is None:
+        return jsonify({
+            "error": "true",
+            "message": "Job not found"
+        }), 404
+
+    return jsonify(status)
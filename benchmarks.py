@@ -0,0 +1,211 @@
+"""
+Benchmarks of the image processing pipeline.
+
+Usage::
+
+    python benchmarks.py aruco [photo.jpg ...]
+    python benchmarks.py illumination [photo.jpg ...]
+    python benchmarks.py bfs
+
+Without photos the benchmarks run on a synthetic photo of a sheet.
+"""
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+from cv2 import aruco
+from PIL import Image
+
+import detection
+from coffeegame import PTS_ORIGIN, CoffeeGame
+from page_layout_render import corner_aruco_size, h, header_size, pd, w
+
+
+def timeit(f, repeats=5):
+    """Best of ``repeats`` runs, in seconds, and the last result."""
+    best = np.inf
+    for _ in range(repeats):
+        start = perf_counter()
+        result = f()
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+def synthetic_photo(pf=10, photo_size=(3024, 4032), crosses=0.05, random_state=42):
+    """
+    Photo of a sheet with the four corner markers, the hex grid and crosses in a
+    random share of the hexes, taken at an angle, with uneven lighting and noise.
+
+    Returns
+    -------
+    Tuple (grayscale photo, {aruco_id: true corner coordinates}, true occupancy vector
+    of ``CoffeeGame.create_grid()``)
+    """
+    rng = np.random.RandomState(random_state)
+    sheet = np.full((h * pf, w * pf), 255, dtype=np.uint8)
+
+    # grid coordinates are in 0.01 mm
+    grid = CoffeeGame.create_grid()
+    polygons = np.array(grid.get_polygons()) * pf / 100
+    cv2.polylines(sheet, np.round(polygons).astype(np.int32), True, 220, thickness=2)
+    occupied = rng.rand(len(grid)) < crosses
+    for cross in np.array(grid.get_crosses())[occupied] * pf / 100:
+        cv2.polylines(sheet, [np.round(cross).astype(np.int32)], False, 40, thickness=int(0.6 * pf))
+
+    positions = {
+        0: (pd, header_size + pd),
+        1: (w - pd - corner_aruco_size, header_size + pd),
+        2: (pd, h - pd - corner_aruco_size),
+        3: (w - pd - corner_aruco_size, h - pd - corner_aruco_size),
+    }
+    aruco_dict = aruco.Dictionary_get(aruco.DICT_ARUCO_ORIGINAL)
+    size = corner_aruco_size * pf
+    for i, (x, y) in positions.items():
+        sheet[y * pf:y * pf + size, x * pf:x * pf + size] = aruco.drawMarker(aruco_dict, i, size)
+
+    pw, ph = photo_size
+    margin = 0.08 * np.array([pw, ph])
+    src = np.float32([[0, 0], [w * pf, 0], [w * pf, h * pf], [0, h * pf]]) - 0.5
+    dst = np.float32([margin, [pw - margin[0], margin[1]], [pw, ph] - margin, [margin[0], ph - margin[1]]])
+    dst += rng.uniform(-0.05, 0.05, size=(4, 2)).astype(np.float32) * [pw, ph]
+    M = cv2.getPerspectiveTransform(src, dst)
+
+    photo = cv2.warpPerspective(sheet, M, photo_size, borderValue=90, flags=cv2.INTER_LINEAR)
+    lighting = np.linspace(0.75, 1, pw)[None, :] * np.linspace(0.85, 1, ph)[:, None]
+    photo = cv2.GaussianBlur(photo * lighting, (5, 5), 0) + rng.normal(0, 4, photo.shape)
+    photo = np.clip(photo, 0, 255).astype(np.uint8)
+
+    corners = {}
+    for i, (x, y) in positions.items():
+        square = np.float32([[x, y], [x + corner_aruco_size, y],
+                             [x + corner_aruco_size, y + corner_aruco_size], [x, y + corner_aruco_size]])
+        # marker edges lie half a pixel away from the pixel centers
+        corners[i] = cv2.perspectiveTransform(square[None] * pf - 0.5, M)[0]
+
+    return photo, corners, occupied
+
+
+def load_gray(path):
+    return np.array(Image.open(path).convert('RGB')).min(axis=2)
+
+
+def sheet_crop(gray):
+    """
+    Warps a photo the way ``CoffeeGame.proceed_image`` does.
+
+    Returns
+    -------
+    Tuple (crop, hex centers on the crop)
+    """
+    gray = detection.gamma_correction(gray, gamma=0.5)
+    crop, coord, _ = detection.DetectionContext(gray).warp(gray, PTS_ORIGIN, [0, 1, 2, 3])
+    points = (np.array(CoffeeGame.create_grid().get_centers()) / 10 - coord).astype(int)
+    return crop, points
+
+
+def corner_errors(found, reference):
+    return np.concatenate([np.linalg.norm(found[i] - corners, axis=1)
+                           for i, corners in reference.items() if i in found])
+
+
+def benchmark_aruco(paths=(), repeats=5, tolerance=1.0):
+    """
+    Compares ``detect_aruco`` with ``detect_aruco_fast``: best time and corner error.
+
+    On real photos the full resolution detection with OpenCV sub-pixel refinement is
+    used as the reference, on the synthetic photo the true corners are known.
+    """
+    if paths:
+        photos = [(path, load_gray(path), None) for path in paths]
+    else:
+        photos = [('synthetic', *synthetic_photo()[:2])]
+
+    for name, gray, reference in photos:
+        full_time, full = timeit(lambda: detection.detect_aruco(gray), repeats)
+        fast_time, fast = timeit(lambda: detection.detect_aruco_fast(gray), repeats)
+
+        print(f"{name} ({gray.shape[1]}x{gray.shape[0]})")
+        print(f"    {full_time:.3f}s - detect_aruco")
+        print(f"    {fast_time:.3f}s - detect_aruco_fast ({full_time / fast_time:.1f}x)")
+
+        if reference is None:
+            parameters = aruco.DetectorParameters_create()
+            parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
+            corners, ids, _ = aruco.detectMarkers(gray, aruco.Dictionary_get(aruco.DICT_ARUCO_ORIGINAL),
+                                                  parameters=parameters)
+            reference = detection.select_markers(corners, ids.ravel())
+            reference = {i: reference[i] for i in detection.CORNER_ARUCO_IDS}
+
+        errors = corner_errors(full, reference)
+        print(f"    detect_aruco corner error: mean {errors.mean():.2f}px, max {errors.max():.2f}px")
+
+        errors = corner_errors(fast, reference)
+        status = 'OK' if errors.max() <= tolerance else 'FAILED'
+        print(f"    detect_aruco_fast corner error: mean {errors.mean():.2f}px, max {errors.max():.2f}px - {status}")
+
+
+def benchmark_illumination(paths=(), repeats=5):
+    """
+    Compares the illumination corrections: best time, difference of the corrected
+    crops and agreement of the detected occupancy.
+
+    On real photos the ``percentile`` method is the reference, on the synthetic photo
+    the crosses are known.
+    """
+    if paths:
+        photos = [(path, load_gray(path), None) for path in paths]
+    else:
+        photo, _, occupied = synthetic_photo()
+        photos = [('synthetic', photo, occupied)]
+
+    for name, gray, reference in photos:
+        crop, points = sheet_crop(gray)
+        print(f"{name} (crop {crop.shape[1]}x{crop.shape[0]})")
+
+        results = {}
+        for method in detection.ILLUMINATION_CORRECTIONS:
+            time, (corrected, _) = timeit(lambda: detection.correct_illumination(crop, method), repeats)
+            results[method] = corrected, detection.check_grid(corrected, points, r=42)
+            print(f"    {time:.3f}s - {method}")
+
+        if reference is None:
+            reference = results['percentile'][1]
+        difference = np.abs(results['morphology'][0].astype(int) - results['percentile'][0]).mean()
+        print(f"    mean absolute difference of the corrected crops: {difference:.1f}")
+        for method, (_, occupied) in results.items():
+            errors = np.sum(np.array(occupied) != reference)
+            print(f"    {method}: {errors} of {len(reference)} hexes differ from the reference")
+
+
+def benchmark_bfs(paths=(), repeats=20):
+    """
+    Traversals of the full A4 grid with ``grid_size=3`` (every hex flagged).
+    """
+    grid = CoffeeGame.create_grid(grid_size=3)
+    grid.flag[:] = 1
+    start = grid.hexs[len(grid) // 2]
+
+    def bfs():
+        grid.color[:] = 0
+        return grid.bfs(start)
+
+    def walk_neigs():
+        return sum(len(h.neigs) for h in grid.hexs)
+
+    print(f"grid_size=3, {len(grid)} hexes")
+    time, component = timeit(bfs, repeats)
+    print(f"    {time * 1000:.2f}ms - HexagonsGrid.bfs ({len(component)} hexes visited)")
+    time, _ = timeit(walk_neigs, repeats)
+    print(f"    {time * 1000:.2f}ms - Hexagon.neigs of every hex")
+    time, _ = timeit(lambda: CoffeeGame.create_grid(grid_size=3), repeats)
+    print(f"    {time * 1000:.2f}ms - CoffeeGame.create_grid (cached)")
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'aruco': benchmark_aruco,
+        'illumination': benchmark_illumination,
+        'bfs': benchmark_bfs,
+    }
+    benchmarks[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,142 @@
+"""
+Bulk generation of game sheets.
+
+Usage::
+
+    python bulk.py games.json [--workers N] [--merge sheets.pdf] [--no-db]
+
+``games.json`` is a list of games, each with the ``/create_game`` parameters:
+``players`` and optionally ``random_state``, ``orientation`` and ``grid_size``.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from uuid import uuid4
+
+from pdfrw import PdfReader, PdfWriter
+
+from coffeegame import CoffeeGame
+from exceptions import PlacementException
+from page_layout_render import fpdf_fonts, grid_path
+
+
+def game_parameters(game: dict) -> dict:
+    return {
+        "players": game.get("players"),
+        "random_state": game.get('random_state', 42),
+        "orientation": game.get('orientation', 'pointy'),
+        "grid_size": game.get('grid_size', 5),
+    }
+
+
+def generate_game(game, url, storage):
+    """
+    Generates the sheet of one game and puts it to the ``storage``. Executed in a
+    worker process.
+
+    Returns
+    -------
+    Dictionary with the columns of the ``Game`` row, or with the error message
+    """
+    parameters = game_parameters(game)
+    uuid = uuid4().hex
+
+    try:
+        cg = CoffeeGame(uuid=uuid, url=url, **parameters)
+    except PlacementException as e:
+        return {"error": "true", "message": str(e)}
+
+    pdf = storage.put(cg.render_game_field(), 'pdf', '.pdf')
+
+    return {**parameters, "uuid": uuid, "pdf": pdf}
+
+
+def warm_up_generation(parameters=(('pointy', 5),)):
+    """
+    Prepares the fonts and the grids of the sheets: before the workers are forked,
+    or as the initializer of the workers, so every worker starts with them cached.
+    """
+    fpdf_fonts()
+    for orientation, grid_size in parameters:
+        grid_path(orientation, grid_size)
+
+
+def generate_games(games, url, storage, executor: ProcessPoolExecutor = None, workers=None):
+    """
+    Generates the sheets of all the games on a pool of worker processes.
+
+    ``executor`` is a long-lived pool started with the app, whose workers run
+    ``warm_up_generation`` first. Without it a temporary pool is forked, which is
+    safe only in a process running no other threads. ``workers``
+    is the number of the worker processes, the number of cores by default.
+
+    Returns
+    -------
+    Tuple (list of the ``generate_game`` results in the order of the games, sheets
+    per second)
+    """
+    start = perf_counter()
+
+    workers = workers or os.cpu_count()
+    temporary = executor is None
+    if temporary:
+        warm_up_generation({(p['orientation'], p['grid_size']) for p in map(game_parameters, games)})
+        workers = min(workers, max(len(games), 1))
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+
+    try:
+        results = list(executor.map(generate_game, games, [url] * len(games), [storage] * len(games),
+                                    chunksize=max(len(games) // (4 * workers), 1)))
+    finally:
+        if temporary:
+            executor.shutdown()
+
+    return results, len(games) / (perf_counter() - start)
+
+
+def merge_sheets(paths, output_name):
+    """
+    Combines the sheets into one multi-page PDF, ``output_name`` is a path or a
+    file object.
+    """
+    pdf_merged = PdfWriter()
+    for path in paths:
+        pdf_merged.addpages(PdfReader(path).pages)
+    pdf_merged.write(output_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates the sheets of many games at once.")
+    parser.add_argument('games', help="JSON file with the list of games")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--merge', default=None, help="also combine all the sheets into this PDF")
+    parser.add_argument('--no-db', action='store_true', help="do not insert the games into the database")
+    args = parser.parse_args()
+
+    with open(args.games) as f:
+        games = json.load(f)
+
+    # the app forks its generation pool on import
+    if args.workers:
+        os.environ['GENERATION_WORKERS'] = str(args.workers)
+    import app
+
+    results, speed = generate_games(games, app.url, app.storage, app.generation_pool.executor,
+                                    app.generation_pool.workers)
+    created = [result for result in results if "error" not in result]
+    print(f"{len(created)} of {len(games)} sheets generated, {speed:.1f} sheets/s")
+    for i, result in enumerate(results):
+        if "error" in result:
+            print(f"    game {i}: {result['message']}")
+
+    if args.merge:
+        merge_sheets([app.storage.path(result['pdf']) for result in created], args.merge)
+        print(f"Sheets combined into {args.merge}")
+
+    if not args.no_db:
+        with app.app.app_context():
+            app.db.session.add_all([app.Game(**result) for result in created])
+            app.db.session.commit()
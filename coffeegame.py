@@ -1,4 +1,7 @@
+import base64
+from dataclasses import dataclass
 from pathlib import Path
+from time import perf_counter
 from typing import Union
 
 import matplotlib.pyplot as plt
@@ -7,11 +10,59 @@ import zbarlight
 from PIL import Image
 
 import detection
-from hexagons import HexagonsGrid
-from page_layout_render import render_page
+from hexagons import cached_grid
+from page_layout_render import render_page, render_sheet
 import cv2 
 
-from exceptions import ImageLoadingException, ImageProcessingException, QRNotFoundException, QRCodeIncorrectException
+from exceptions import (ImageLoadingException, ImageProcessingException, PlacementException, QRCodeIncorrectException,
+                        QRNotFoundException)
+
+# version of the compact QR payload written by CoffeeGame.encode_string
+PAYLOAD_VERSION = 1
+
+# positions of the outer corners of the corner ArUco markers on the sheet, in 0.1 mm
+PTS_ORIGIN = np.array([[5, 60], [205, 60], [5, 292], [205, 292]]) * 10
+
+
+def zigzag(value):
+    return 2 * value if value >= 0 else -2 * value - 1
+
+
+def unzigzag(value):
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+def write_varint(payload: bytearray, value):
+    while value >= 0x80:
+        payload.append(value & 0x7f | 0x80)
+        value >>= 7
+    payload.append(value)
+
+
+def read_varint(payload: bytes, position):
+    value, shift = 0, 0
+    while True:
+        byte = payload[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+@dataclass
+class RuleViolations:
+    """
+    Breaches of the rules printed on the sheet.
+
+    distances : (P, P) minimal hex distances between the territories of the players
+    too_close : pairs of players (i < j) whose territories are closer than allowed
+    disconnected : pairs (player, hexagon indices) of the regions of crosses not
+        connected to any start hexagon, attributed to the nearest player
+    """
+    distances: np.ndarray
+    too_close: list
+    disconnected: list
 
 
 class CoffeeGame:
@@ -38,23 +89,55 @@ class CoffeeGame:
     def __len__(self):
         return len(self.hex_grid)
 
-    def generate_arrangement(self, n, threshold=4, border_dist=2):
-        r = np.random.RandomState(self.random_state)
-        while True:
-            hexs = r.choice([h for h in self.hex_grid.hexs if h.border_dist >= border_dist], n, replace=False).tolist()
-            if n <= 1:
-                break
+    def generate_arrangement(self, n, threshold=4, border_dist=2, attempts=10):
+        """
+        Places ``n`` players on hexagons at least ``border_dist`` away from the border
+        of the grid and more than ``threshold`` apart from each other.
 
-            min_dist = len(hexs[0] - hexs[1])
-            for i in range(len(hexs)):
-                for j in range(len(hexs)):
-                    if i != j:
-                        min_dist = min(len(hexs[i] - hexs[j]), min_dist)
+        Random sequential sampling: candidates are visited in a random order and each
+        accepted hexagon removes its neighbourhood from the candidates. After
+        ``attempts`` failed orders a greedy farthest-point placement is tried.
+        Deterministic for a given ``random_state``.
 
-            if min_dist > threshold:
-                break
+        Raises
+        ------
+        PlacementException if the players do not fit on the grid
+        """
+        if n == 0:
+            return []
 
-        return hexs
+        grid = self.hex_grid
+        r = np.random.RandomState(self.random_state)
+        candidates = np.flatnonzero(grid.border_dist >= border_dist)
+        q, s = grid.q[candidates], -grid.q[candidates] - grid.r[candidates]
+
+        def distances(i):
+            return np.maximum(np.maximum(np.abs(q - q[i]), np.abs(s - s[i])), np.abs(q + s - q[i] - s[i]))
+
+        if n > len(candidates):
+            raise PlacementException
+
+        for _ in range(attempts):
+            free = np.ones(len(candidates), dtype=bool)
+            selected = []
+            for i in r.permutation(len(candidates)):
+                if free[i]:
+                    selected.append(i)
+                    free &= distances(i) > threshold
+                    if len(selected) == n:
+                        return [grid.hexs[j] for j in candidates[selected]]
+
+        # farthest-point placement spreads the players as much as possible
+        selected = [r.randint(len(candidates))]
+        nearest = distances(selected[0])
+        while len(selected) < n:
+            i = int(nearest.argmax())
+            if nearest[i] <= threshold:
+                raise PlacementException
+            selected.append(i)
+            nearest = np.minimum(nearest, distances(i))
+
+        return [grid.hexs[j] for j in candidates[selected]]
 
     def load_config(self, config):
         self.hex_grid = self.create_grid(orientation=config['orientation'], grid_size=config['grid_size'])
@@ -65,23 +148,47 @@ class CoffeeGame:
     def export_config(self):  # not clean function
         return self.config
 
-    def proceed_image(self, image_path: Union[str, Path]):
+    def proceed_image(self, image_path: Union[str, Path], illumination='morphology', store=None, roster=None):
+        """
+        Recognizes the sheet on the photo.
+
+        ``roster`` maps the uuid of the game to its player names (None for unknown
+        games), compact QR payloads do not carry them. With a ``GameStore`` the state
+        of the sheet is kept between uploads: the components are updated from the
+        previous state and ``get_delta`` reports the crosses added since the previous
+        photo.
+        """
         try:
-            image = Image.open(image_path).convert('RGB')
+            decoding_start = perf_counter()
+            image = detection.load_photo(image_path)
+            decoding_time = perf_counter() - decoding_start
         except Exception as e:
             print(str(e))
             raise ImageLoadingException
 
+        pts_origin = PTS_ORIGIN
+
         try:
-            pts_origin = np.array([[5, 60], [205, 60], [5, 292], [205, 292]]) * 10
-            crop_with_qr, _, _ = detection.apply_perspective(np.array(image), pts_origin, [0, 1, 2, 3], for_qr=True)
-            qr_image = np.rot90(crop_with_qr, 2)[:480, 1500:]
-            qr_image = Image.fromarray(qr_image)
+            rgb = np.array(image)
+            if rgb.shape[0] < rgb.shape[1]:
+                rgb = np.ascontiguousarray(np.rot90(rgb, k=3))
+
+            # markers are detected once on the corrected gray image and reused by every stage
+            corrected_rgb = detection.gamma_correction(rgb, gamma=0.5)
+            gray = corrected_rgb.min(axis=2).astype(np.uint8)
+            context = detection.DetectionContext(gray)
+            context.timings['Image decoding'] = decoding_time
+            context.detect()
+
+            with context.stage('QR crop'):
+                crop_with_qr, _, _ = context.warp(rgb, pts_origin, [0, 1, 2, 3], for_qr=True)
+                qr_image = np.rot90(crop_with_qr, 2)[:480, 1500:]
+                qr_image = Image.fromarray(qr_image)
         except:
             raise ImageProcessingException
 
-
-        qr_code_value = detection.decode_qr(qr_image, image)
+        with context.stage('QR decoding'):
+            qr_code_value = detection.decode_qr(qr_image, image)
 
         try:
             config, url, uuid = self.decode_string(qr_code_value)
@@ -89,56 +196,68 @@ class CoffeeGame:
             self.url = url
             self.uuid = uuid
             self.load_config(config)
+
+            # compact payloads do not carry the names
+            names = roster(uuid) if roster is not None else None
+            if names is not None and len(names) == len(config['players']):
+                for player, name in zip(config['players'], names):
+                    player['name'] = name
+
+            # index_of gives -1 outside the grid, which would alias the last hexagon
+            starts = [self.hex_grid.index_of(*player['coords']) for player in self.config['players']]
+            if min(starts, default=0) < 0:
+                raise ValueError("Start hexagon outside of the grid")
         except Exception as e:
             print(str(e))
             raise QRCodeIncorrectException
 
-        image = np.array(image)
-
-        if image.shape[0] < image.shape[1]:
-            image = np.rot90(image, k=3)
-
         # recognition
         try:
-            image = detection.gamma_correction(image, gamma=0.5)
-            gray = image.min(axis=2).astype(np.uint8)
-
-            pts_origin = np.array([[5, 60], [205, 60], [5, 292], [205, 292]]) * 10
-            crop, coord, transform_matrix = detection.apply_perspective(gray, pts_origin, [0, 1, 2, 3])
+            with context.stage('Grid warp'):
+                crop, coord, transform_matrix = context.warp(gray, pts_origin, [0, 1, 2, 3])
 
             p = np.array(self.hex_grid.get_centers()) / 10 - coord
 
-            corrected, illumination_mask = detection.threshold_makrers_illumanation(crop)
+            with context.stage('Illumination correction'):
+                corrected, illumination_mask = detection.correct_illumination(crop, method=illumination)
+
+            with context.stage('Occupancy'):
+                points = p.astype(int).tolist()
+                hexes = detection.check_grid(corrected, grid=points, r=42)
 
-            points = p.astype(int).tolist()
-            hexes = detection.check_grid(corrected, grid=points, r=42)
+            with context.stage('Components'):
+                indices = self.hex_grid.get_indices_by_coords((np.array(points) + coord) * 10)
+                occupied = np.zeros(len(self.hex_grid), dtype=bool)
+                occupied[indices[np.array(hexes)]] = True
 
-            hexs = [self.hex_grid.get_hexagon_by_coord(*((p + coord) * 10)) for h, p in zip(hexes, np.array(points)) if h]
-            for h in hexs:
-                h.flag = 1
+                players = self.config['players']
 
-            for h in self.hex_grid.hexs:
-                h.color = 0
+                previous_occupied, previous_labels = None, None
+                if store is not None:
+                    previous_occupied, previous_labels = store.load_state(self.uuid) or (None, None)
 
-            components = []
+                territories = self.hex_grid.update_territories(starts, occupied, previous_occupied, previous_labels)
+                if store is not None:
+                    store.save_state(self.uuid, territories.occupied, territories.labels)
+                self.delta = self.compare_states(territories, starts, previous_occupied)
 
-            colors = {}
-            for index, player in enumerate(self.config['players']):
-                q, r = player['coords']
-                components.append(self.hex_grid.bfs(self.hex_grid[q, r]))
-                for h in components[-1]:
-                    colors[h] = len(components)
-                    self.config['players'][index]['components'].append([h.q, h.r])
+                for player, start, component in zip(players, starts, territories.components):
+                    # the start hexagon first, as the bfs listed it
+                    component = np.concatenate([[start], component[component != start]])
+                    player['components'] += np.stack([self.hex_grid.q[component],
+                                                      self.hex_grid.r[component]], axis=1).tolist()
 
+                hexes = (territories.players[indices] + 1).tolist()
 
-            hexes = [colors.get(self.hex_grid.get_hexagon_by_coord(*((p + coord) * 10)), 0) for h, p in zip(hexes, np.array(points))]
+            with context.stage('Rules'):
+                self.violations = self.check_rules(territories)
 
-            arucos = detection.detect_aruco(gray)
             return detection.DetectionStages(
-                image=image, arucos=arucos,
+                image=corrected_rgb, arucos=context.arucos,
                 pts_origin=pts_origin, crop=crop, corrected=corrected,
                 illumination_mask=illumination_mask, hexes=hexes,
-                r=50, points=points, orientation='pointy', transform=transform_matrix
+                r=50, points=points, orientation='pointy', transform=transform_matrix,
+                timings=context.timings
             )
         except Exception as e:
             print(str(e))
@@ -147,6 +266,9 @@ class CoffeeGame:
     def generate_game_field(self, path):
         render_page(self.config, self.encode_string(self.config, self.url, self.uuid), output_name=path)
 
+    def render_game_field(self) -> bytes:
+        return render_sheet(self.config, self.encode_string(self.config, self.url, self.uuid))
+
     def rename_players(self, players: dict):
         for player in self.config['players']:
             player['name'] = players.get(player['name'], player['name'])
@@ -169,6 +291,83 @@ class CoffeeGame:
         if save:
             fig.savefig(save, dpi=100, bbox_inches='tight')
 
+    def check_rules(self, territories, min_distance=2) -> RuleViolations:
+        """
+        Checks that the crosses of every player stay connected and that the
+        territories of different players are at least ``min_distance`` apart
+        (at least one empty tile between them by default).
+        """
+        grid = self.hex_grid
+        components = territories.components
+        fields = grid.distance_fields(components)
+
+        # distance from the territory of every player (rows) to the others (columns)
+        starts = np.cumsum([0] + [len(component) for component in components[:-1]])
+        if len(components) != 0:
+            distances = np.minimum.reduceat(fields[:, np.concatenate(components)], starts, axis=1)
+        else:
+            distances = np.zeros((0, 0), dtype=int)
+        distances = np.minimum(distances, distances.T)
+        np.fill_diagonal(distances, 0)
+
+        i, j = np.nonzero(np.triu(distances < min_distance, k=1))
+        too_close = list(zip(i.tolist(), j.tolist()))
+
+        disconnected = []
+        if len(components) != 0 and len(territories.unassigned) != 0:
+            regions = territories.unassigned
+            starts = np.cumsum([0] + [len(region) for region in regions[:-1]])
+            nearest = np.minimum.reduceat(fields[:, np.concatenate(regions)], starts, axis=1).argmin(axis=0)
+            disconnected = list(zip(nearest.tolist(), regions))
+
+        return RuleViolations(distances=distances, too_close=too_close, disconnected=disconnected)
+
+    @staticmethod
+    def compare_states(territories, starts, previous_occupied=None):
+        """
+        Returns
+        -------
+        Tuple (number of the new crosses of every player, number of the new crosses
+        not connected to any player, number of the crosses which disappeared) since
+        the previous state, since the blank sheet without it.
+        """
+        occupied = territories.occupied
+        if previous_occupied is None or len(previous_occupied) != len(occupied):
+            previous_occupied = np.zeros_like(occupied)
+            previous_occupied[starts] = True
+
+        added = territories.players[occupied & ~previous_occupied]
+        counts = np.bincount(added + 1, minlength=len(territories.components) + 1)
+
+        return counts[1:], int(counts[0]), int(np.sum(previous_occupied & ~occupied))
+
+    def get_delta(self):
+        new_crosses, disconnected, removed = self.delta
+
+        return {
+            "players": [{
+                "name": player["name"],
+                "new_crosses": int(crosses)
+            } for player, crosses in zip(self.config["players"], new_crosses)],
+            "disconnected": disconnected,
+            "removed": removed
+        }
+
+    def get_violations(self):
+        players = self.config["players"]
+        violations = self.violations
+
+        return {
+            "too_close": [{
+                "players": [players[i]["name"], players[j]["name"]],
+                "distance": int(violations.distances[i, j])
+            } for i, j in violations.too_close],
+            "disconnected": [{
+                "name": players[player]["name"],
+                "crosses": len(region)
+            } for player, region in violations.disconnected]
+        }
+
     def get_number_of_cups(self):
         return [{
             "name": player["name"],
@@ -177,21 +376,77 @@ class CoffeeGame:
 
     @staticmethod
     def encode_string(data: dict, url, uuid) -> str:
-        s = f'uuid={uuid}&'
-        if data['orientation'] == "pointy":
-            s += 'p'
-        else:
-            s += 'f'
-
-        s += '='
-        s += str(data['grid_size'])
+        """
+        Compact QR payload ``<URL>/<version><base32 data>``, made only of the QR
+        alphanumeric characters, so the code stays small with many players.
+
+        Data of version 1: uuid (length and bytes), grid size in 0.1 mm times two
+        plus the orientation bit, number of players and zigzag coordinates of every
+        player, all varints. Player names are not included, they are kept by the
+        server (``Game.players``).
+        """
+        payload = bytearray()
+        uuid = bytes.fromhex(uuid)
+        write_varint(payload, len(uuid))
+        payload += uuid
+        write_varint(payload, 2 * round(data['grid_size'] * 10) + (data['orientation'] == 'flat'))
+        write_varint(payload, len(data['players']))
         for player in data['players']:
-            s += f"&{player['name']}={player['coords'][0]},{player['coords'][1]}"
+            q, r = player['coords']
+            write_varint(payload, zigzag(q))
+            write_varint(payload, zigzag(r))
+
+        encoded = base64.b32hexencode(bytes(payload)).decode().rstrip('=')
 
-        return f"{url}?{s}"
+        return f"{url.upper()}/{PAYLOAD_VERSION}{encoded}"
 
     @staticmethod
     def decode_string(s: str) -> tuple:
+        """
+        Decodes both the compact payload of ``encode_string`` and the query string
+        ``<url>?uuid=<uuid>&<p|f>=<grid size>&<name>=<q>,<r>...`` of the older sheets.
+        Players of compact payloads are named ``Player <n>``.
+
+        Returns
+        -------
+        Tuple (config, url, uuid)
+        """
+        if '?' in s:
+            return CoffeeGame.decode_legacy_string(s)
+
+        url, _, encoded = s.rpartition('/')
+        if encoded[:1] != str(PAYLOAD_VERSION):
+            raise QRCodeIncorrectException
+
+        encoded = encoded[1:]
+        payload = base64.b32hexdecode(encoded + '=' * (-len(encoded) % 8))
+
+        length, position = read_varint(payload, 0)
+        uuid = payload[position:position + length].hex()
+        position += length
+        grid, position = read_varint(payload, position)
+        n, position = read_varint(payload, position)
+
+        players = []
+        for i in range(n):
+            q, position = read_varint(payload, position)
+            r, position = read_varint(payload, position)
+            players.append({
+                "name": f"Player {i + 1}",
+                "coords": [unzigzag(q), unzigzag(r)],
+                "components": []
+            })
+
+        grid_size = grid // 2 / 10
+        data = {
+            "orientation": 'flat' if grid % 2 else 'pointy',
+            "grid_size": int(grid_size) if grid_size.is_integer() else grid_size,
+            "players": players
+        }
+        return data, url.lower(), uuid
+
+    @staticmethod
+    def decode_legacy_string(s: str) -> tuple:
         url = s.split("?")[0]
         uuid = s.split("?")[-1].split("&")[0].split("=")[-1]
         s = "&".join(s.split("?")[-1].split("&")[1:])
@@ -215,9 +470,66 @@ class CoffeeGame:
         header_size = 55  # height fo the header in mm
         corner_aruco_size = 8  # size of the corner aruco markers in mm
 
-        return HexagonsGrid(
+        return cached_grid(
             orientation=orientation,
             size=grid_size * pf,
             start_pos=((pd + 10) * pf, (header_size + pd + 15) * pf),
             corners=(((pd + 10) * pf, (header_size + pd + 15) * pf), ((w - pd - 10) * pf, (h - pd - 15) * pf))
         )
+
+
+def test_payload_roundtrip():
+    config = {
+        "orientation": 'flat',
+        "grid_size": 3.5,
+        "players": [{"name": name, "coords": coords, "components": []}
+                    for name, coords in [('Alice Smith', [0, 0]), ('Bob Jones', [-3, 17]), ('Carl Sagan', [130, -64])]]
+    }
+    uuid = '0123456789abcdef0123456789abcdef'
+
+    s = CoffeeGame.encode_string(config, 'coffee-game.ai', uuid)
+    assert s.startswith(f"COFFEE-GAME.AI/{PAYLOAD_VERSION}")
+
+    data, url, decoded_uuid = CoffeeGame.decode_string(s)
+    assert (url, decoded_uuid) == ('coffee-game.ai', uuid)
+    assert (data['orientation'], data['grid_size']) == ('flat', 3.5)
+    assert [p['coords'] for p in data['players']] == [p['coords'] for p in config['players']]
+    assert [p['name'] for p in data['players']] == ['Player 1', 'Player 2', 'Player 3']
+
+    data, _, _ = CoffeeGame.decode_string(CoffeeGame.encode_string({**config, "orientation": 'pointy', "grid_size": 5},
+                                                                   'coffee-game.ai', uuid))
+    assert (data['orientation'], data['grid_size']) == ('pointy', 5)
+    assert isinstance(data['grid_size'], int)
+
+
+def test_payload_legacy():
+    data, url, uuid = CoffeeGame.decode_string(
+        'coffee-game.ai?uuid=0123456789abcdef0123456789abcdef&p=5&Alice Smith=11,9&Bob Jones=-2,14')
+    assert (url, uuid) == ('coffee-game.ai', '0123456789abcdef0123456789abcdef')
+    assert (data['orientation'], data['grid_size']) == ('pointy', 5)
+    assert data['players'] == [
+        {"name": 'Alice Smith', "coords": [11, 9], "components": []},
+        {"name": 'Bob Jones', "coords": [-2, 14], "components": []},
+    ]
+
+
+def test_payload_unknown_version():
+    s = CoffeeGame.encode_string({"orientation": 'pointy', "grid_size": 5, "players": []},
+                                 'coffee-game.ai', '0123456789abcdef0123456789abcdef')
+    url, _, encoded = s.rpartition('/')
+    try:
+        CoffeeGame.decode_string(f"{url}/{PAYLOAD_VERSION + 1}{encoded[1:]}")
+    except QRCodeIncorrectException:
+        pass
+    else:
+        raise AssertionError("unknown payload version decoded")
+
+
+def test_all():
+    test_payload_roundtrip()
+    test_payload_legacy()
+    test_payload_unknown_version()
+
+
+if __name__ == '__main__':
+    test_all()
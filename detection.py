@@ -1,107 +1,294 @@
-from dataclasses import dataclass
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from itertools import product
+from time import perf_counter
 from typing import Union
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 from cv2 import aruco
+from matplotlib.colors import to_rgb
 from matplotlib.patches import RegularPolygon
 from scipy import ndimage
 import zbarlight
+from PIL import Image, ImageOps
 
 from exceptions import QRNotFoundException
 
+COLOR_CLASSES = ['blue', 'red', 'yellowgreen', 'purple', 'forestgreen',
+                 'darkorange', 'peru', 'gold', 'aqua', 'springgreen', 'firebrick'] * 2
 
-def decode_qr(qr_image, full_image):
-    print("Trying to decode QR code from cropped image...")
-    try:
-        print('Using zbarlight...', end=' ')
-        qr_code_value = zbarlight.scan_codes(['qrcode'], qr_image)[0].decode('utf-8')
-    except:
-        print('FAILED')
-    else:
-        print('OK')
-        return qr_code_value
-
-    try: 
-        print('Using cv2...', end=' ')
-        qrCodeDetector = cv2.QRCodeDetector()
-        qr_code_value, _, _ = qrCodeDetector.detectAndDecode(np.array(qr_image))
-        assert qr_code_value != ''
-    except:
-        print('FAILED')
-    else:
-        print('OK')
-        return qr_code_value
 
-    print("Trying to decode QR code from full image...")
+def class_color(h):
+    """
+    Color of the hex class, class 0 is empty and the players cycle through the rest
+    of the palette.
+    """
+    return COLOR_CLASSES[(h - 1) % (len(COLOR_CLASSES) - 1) + 1] if h > 0 else COLOR_CLASSES[0]
 
-    try:
-        print('Using zbarlight...', end=' ')
-        qr_code_value = zbarlight.scan_codes(['qrcode'], full_image)[0].decode('utf-8')
-    except:
-        print('FAILED')
-    else:
-        print('OK')
-        return qr_code_value
-
-    try: 
-        print('Using cv2...', end=' ')
-        qrCodeDetector = cv2.QRCodeDetector()
-        qr_code_value, _, _ = qrCodeDetector.detectAndDecode(np.array(full_image))
-        assert qr_code_value != ''
-    except:
-        print('FAILED')
-    else:
-        print('OK')
-        return qr_code_value
 
-    print("Trying to decode QR code from full image resized to 2000px...")
+def zbarlight_decode(image):
+    return zbarlight.scan_codes(['qrcode'], image)[0].decode('utf-8')
 
-    smaller_image = full_image.resize((int(full_image.size[0] * 2000 / max(full_image.size)),
-                            int(full_image.size[1] * 2000 / max(full_image.size))))
 
-    try:
-        print('Using zbarlight...', end=' ')
-        qr_code_value = zbarlight.scan_codes(['qrcode'], smaller_image)[0].decode('utf-8')
-    except:
-        print('FAILED')
-    else:
-        print('OK')
-        return qr_code_value
-
-    try: 
-        print('Using cv2...', end=' ')
-        qrCodeDetector = cv2.QRCodeDetector()
-        qr_code_value, _, _ = qrCodeDetector.detectAndDecode(np.array(smaller_image))
-        assert qr_code_value != ''
-    except:
-        print('FAILED')
-    else:
-        print('OK')
-        return qr_code_value
+def cv2_decode(image):
+    qrCodeDetector = cv2.QRCodeDetector()
+    qr_code_value, _, _ = qrCodeDetector.detectAndDecode(np.array(image))
+    assert qr_code_value != ''
+    return qr_code_value
 
-    raise QRNotFoundException
 
+def load_photo(fp, long_side=4000) -> Image.Image:
+    """
+    Decodes the photo once, upright and in RGB.
 
-def detect_aruco(image: np.ndarray):
+    JPEGs larger than needed are decoded at a reduced scale (DCT scaling of libjpeg),
+    keeping the longest side at least ``long_side`` px: the sheet is warped to 10 px/mm
+    and its ~300 mm never span more than that, so 12 MP photos are decoded as is and
+    48 MP ones at half of the resolution. The EXIF orientation is applied.
+    """
+    image = Image.open(fp)
+
+    scale = long_side / max(image.size)
+    if image.format == 'JPEG' and scale < 1:
+        image.draft('RGB', (int(np.ceil(image.size[0] * scale)), int(np.ceil(image.size[1] * scale))))
+
+    return ImageOps.exif_transpose(image).convert('RGB')
+
+
+def resize_longest_side(image, size=2000):
+    return image.resize((int(image.size[0] * size / max(image.size)),
+                         int(image.size[1] * size / max(image.size))))
+
+
+# strategies in the order they were tried before any statistics were collected
+QR_STRATEGIES = {
+    'zbarlight, cropped image': lambda qr_image, full_image: zbarlight_decode(qr_image),
+    'cv2, cropped image': lambda qr_image, full_image: cv2_decode(qr_image),
+    'zbarlight, full image': lambda qr_image, full_image: zbarlight_decode(full_image),
+    'cv2, full image': lambda qr_image, full_image: cv2_decode(full_image),
+    'zbarlight, full image resized to 2000px': lambda qr_image, full_image: zbarlight_decode(resize_longest_side(full_image)),
+    'cv2, full image resized to 2000px': lambda qr_image, full_image: cv2_decode(resize_longest_side(full_image)),
+}
+
+
+class QRDecodingCascade:
+    """
+    Runs QR decoding strategies concurrently on a thread pool and returns the first
+    successful decode.
+
+    Strategies are submitted in the order of their observed success rate (and mean
+    time as a tie-breaker), so with fewer workers than strategies the ones that
+    usually work start first. Strategies still waiting for a worker are cancelled
+    once a value is found, the running ones are ignored.
+
+    Parameters
+    ----------
+    strategies : dict
+        {name: callable(qr_image, full_image) -> str}. A strategy fails by raising.
+    max_workers : int
+        Size of the thread pool, all strategies run at once by default
+    """
+
+    def __init__(self, strategies: dict, max_workers=None):
+        self.strategies = dict(strategies)
+        self.max_workers = max_workers or len(self.strategies)
+        self.stats = {name: {"attempts": 0, "successes": 0, "time": 0.0} for name in self.strategies}
+        self._lock = threading.Lock()
+        self._executor = None
+        # threads do not survive fork, a forked worker has to start its own pool
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='qr')
+            return self._executor
+
+    def shutdown(self):
+        """
+        Stops the threads of the pool, the next ``decode`` starts a new one.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def order(self) -> list:
+        def score(name):
+            stats = self.stats[name]
+            success_rate = (stats["successes"] + 1) / (stats["attempts"] + 2)
+            mean_time = stats["time"] / stats["attempts"] if stats["attempts"] else 0
+            return -success_rate, mean_time
+
+        with self._lock:
+            return sorted(self.strategies, key=score)
+
+    def _run(self, name, qr_image, full_image):
+        start = perf_counter()
+        try:
+            value = self.strategies[name](qr_image, full_image)
+        except Exception:
+            value = None
+        elapsed = perf_counter() - start
+
+        with self._lock:
+            self.stats[name]["attempts"] += 1
+            self.stats[name]["successes"] += value is not None
+            self.stats[name]["time"] += elapsed
+
+        return value, elapsed
+
+    def decode(self, qr_image, full_image) -> str:
+        executor = self.executor
+        futures = {executor.submit(self._run, name, qr_image, full_image): name for name in self.order()}
+
+        try:
+            for future in as_completed(futures):
+                value, elapsed = future.result()
+                if value is None:
+                    print(f"Decoding QR code using {futures[future]}... FAILED ({elapsed:.2f}s)")
+                    continue
+
+                print(f"Decoding QR code using {futures[future]}... OK ({elapsed:.2f}s)")
+                return value
+        finally:
+            for future in futures:
+                future.cancel()
+
+        raise QRNotFoundException
+
+
+# two workers: the cheap strategies on the cropped image start first and the expensive
+# full image ones are usually cancelled before they start
+qr_cascade = QRDecodingCascade(QR_STRATEGIES, max_workers=2)
+
+
+def decode_qr(qr_image, full_image):
+    return qr_cascade.decode(qr_image, full_image)
+
+
+# ArUco markers printed on the sheet: four corner markers and the player marker
+SHEET_ARUCO_IDS = (0, 1, 2, 3, 10)
+CORNER_ARUCO_IDS = (0, 1, 2, 3)
+
+
+def detect_aruco(image: np.ndarray, fast=False):
     """
     Parameters
     ----------
     image : np.ndarray
         Grayscale image
+    fast : bool
+        Use ``detect_aruco_fast``
 
     Returns
     -------
     Dictionary {aruco_id: corner_coodrinates}
     """
+    if fast:
+        return detect_aruco_fast(image)
+
     aruco_dict = aruco.Dictionary_get(aruco.DICT_ARUCO_ORIGINAL)
     parameters = aruco.DetectorParameters_create()
     corners, ids, rejectedImgPoints = aruco.detectMarkers(image, aruco_dict, parameters=parameters)
-    aruco_found = {int(id): corner[0] for id, corner in zip(ids, corners)}
+    aruco_found = select_markers(corners, [] if ids is None else ids.ravel())
     return aruco_found
 
 
+@lru_cache(maxsize=None)
+def sheet_aruco_dictionary(ids=SHEET_ARUCO_IDS):
+    """
+    ``DICT_ARUCO_ORIGINAL`` restricted to the given ids. Marker ``ids[i]`` is
+    reported by ``aruco.detectMarkers`` as ``i``.
+    """
+    aruco_dict = aruco.Dictionary_get(aruco.DICT_ARUCO_ORIGINAL)
+    aruco_dict.bytesList = aruco_dict.bytesList[list(ids)]
+    return aruco_dict
+
+
+def select_markers(corners, found_ids) -> dict:
+    """
+    Builds {aruco_id: corner_coodrinates} from the output of ``aruco.detectMarkers``.
+
+    When a corner marker is detected more than once, keeps the combination of
+    corner markers closest to a parallelogram: the outer corners of the sheet
+    satisfy ``top_left + bottom_right == top_right + bottom_left`` up to perspective.
+    """
+    candidates = {}
+    for id, corner in zip(found_ids, corners):
+        candidates.setdefault(int(id), []).append(corner[0])
+
+    aruco_found = {id: corners[-1] for id, corners in candidates.items()}
+    if not set(CORNER_ARUCO_IDS) <= candidates.keys():
+        return aruco_found
+
+    def residual(combination):
+        top_left, top_right, bottom_left, bottom_right = combination
+        return np.linalg.norm(top_left[0] + bottom_right[2] - top_right[1] - bottom_left[3])
+
+    best = min(product(*[candidates[id] for id in CORNER_ARUCO_IDS]), key=residual)
+    aruco_found.update(zip(CORNER_ARUCO_IDS, best))
+    return aruco_found
+
+
+def detect_aruco_fast(image: np.ndarray, ids=SHEET_ARUCO_IDS, required=CORNER_ARUCO_IDS, max_size=1000):
+    """
+    Finds markers on a downscaled copy of the image, matching only the ids used by
+    the sheet, and refines the corners with sub-pixel accuracy on the full image.
+    Falls back to the full resolution if any of the required markers is missing.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Grayscale image
+    ids : tuple
+        Marker ids to look for
+    required : tuple
+        Marker ids that have to be found on the downscaled copy
+    max_size : int
+        Longest side of the downscaled copy in pixels
+
+    Returns
+    -------
+    Dictionary {aruco_id: corner_coodrinates}
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+    aruco_dict = sheet_aruco_dictionary(tuple(ids))
+    parameters = aruco.DetectorParameters_create()
+
+    scale = min(1, max_size / max(image.shape))
+    if scale < 1:
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        corners, found, _ = aruco.detectMarkers(small, aruco_dict, parameters=parameters)
+        found = [] if found is None else [ids[i] for i in found.ravel()]
+        # pixel centers of the downscaled copy back to the full resolution
+        aruco_found = select_markers([(corner + 0.5) / scale - 0.5 for corner in corners], found)
+
+        if set(required) <= aruco_found.keys():
+            window = max(5, int(round(2 / scale)))
+            points = np.concatenate(list(aruco_found.values())).astype(np.float32)
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+            cv2.cornerSubPix(image, points, (window, window), (-1, -1), criteria)
+            return {id: corner for id, corner in zip(aruco_found, points.reshape(-1, 4, 2))}
+
+    corners, found, _ = aruco.detectMarkers(image, aruco_dict, parameters=parameters)
+    found = [] if found is None else [ids[i] for i in found.ravel()]
+    return select_markers(corners, found)
+
+
 def show_aruco(image: np.ndarray, aruco_found: dict, ax=None):
     if ax is None:
         plt.figure(figsize=(10, 10))
@@ -113,9 +300,7 @@ def show_aruco(image: np.ndarray, aruco_found: dict, ax=None):
     ax.legend()
 
 
-def apply_perspective(image: np.ndarray, points_origin, ids: list, for_qr=False):
-    aruco_found = detect_aruco(image)
-
+def get_perspective_transform(aruco_found: dict, points_origin, ids: list, for_qr=False):
     points_image = np.stack([aruco_found[ids[0]][0],
                              aruco_found[ids[1]][1],
                              aruco_found[ids[2]][3],
@@ -125,18 +310,81 @@ def apply_perspective(image: np.ndarray, points_origin, ids: list, for_qr=False)
     min_coord = points_origin.min(axis=0).astype(int)
     points_origin -= min_coord
     image_orig_size = points_origin.max(axis=0).astype(int)
-    
-        
+
     if for_qr:
         points_origin = points_origin[::-1]
         image_orig_size = (image_orig_size * np.array([1, 1.22])).astype(int)
-    
+
     M = cv2.getPerspectiveTransform(points_image, points_origin)
+
+    return M, min_coord, image_orig_size
+
+
+def apply_perspective(image: np.ndarray, points_origin, ids: list, for_qr=False, aruco_found=None):
+    if aruco_found is None:
+        aruco_found = detect_aruco(image)
+
+    M, min_coord, image_orig_size = get_perspective_transform(aruco_found, points_origin, ids, for_qr=for_qr)
     dst = cv2.warpPerspective(image, M, image_orig_size)
 
     return dst, min_coord, M
 
 
+class DetectionContext:
+    """
+    Detects the ArUco markers of a photo once and shares them (and the perspective
+    transforms derived from them) between the stages of the pipeline.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Grayscale image the markers are detected on. Every image warped through
+        the context must have the same geometry.
+    fast : bool
+        Detect markers with ``detect_aruco_fast``
+    """
+
+    def __init__(self, image: np.ndarray, fast=True):
+        self.image = image
+        self.fast = fast
+        self.timings = {}
+        self._arucos = None
+        self._transforms = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + perf_counter() - start
+
+    def detect(self) -> dict:
+        """
+        Detects the markers on the first call, later calls return the same result.
+        """
+        if self._arucos is None:
+            with self.stage('ArUco detection'):
+                self._arucos = detect_aruco(self.image, fast=self.fast)
+        return self._arucos
+
+    @property
+    def arucos(self) -> dict:
+        return self.detect()
+
+    def perspective(self, points_origin, ids: list, for_qr=False):
+        key = (np.asarray(points_origin).tobytes(), tuple(ids), for_qr)
+        if key not in self._transforms:
+            self._transforms[key] = get_perspective_transform(self.arucos, points_origin, ids, for_qr=for_qr)
+        return self._transforms[key]
+
+    def warp(self, image: np.ndarray, points_origin, ids: list, for_qr=False):
+        M, min_coord, image_orig_size = self.perspective(points_origin, ids, for_qr=for_qr)
+        dst = cv2.warpPerspective(image, M, image_orig_size)
+
+        return dst, min_coord, M
+
+
 def threshold_markers_CLAHE(image: np.ndarray):
     assert len(image.shape) == 2
 
@@ -159,6 +407,52 @@ def threshold_makrers_illumanation(image: np.ndarray):
     return corrected, mask_large
 
 
+def threshold_markers_illumination_morphology(image: np.ndarray):
+    """
+    Same stages as ``threshold_makrers_illumanation`` built on OpenCV primitives:
+    the paper brightness is estimated with a max filter (dilation) and a median
+    filter on a copy downscaled 8 times, the correction uses saturating arithmetic,
+    and the dark clipping value is taken from the histogram.
+    """
+    image = cv2.GaussianBlur(image, (11, 11), 0)
+    image_mini = cv2.resize(image, (0, 0), fx=0.125, fy=0.125, interpolation=cv2.INTER_AREA)
+    mask = cv2.dilate(image_mini, np.ones((3, 3), np.uint8))
+    mask = cv2.medianBlur(mask, 7)
+    mask_large = cv2.resize(mask, image.shape[::-1])
+
+    # image + 250 - mask clipped to [0, 255] without leaving uint8
+    corrected = cv2.add(image, cv2.subtract(250, mask_large))
+    corrected = cv2.subtract(corrected, cv2.subtract(mask_large, 250))
+
+    histogram = cv2.calcHist([corrected], [0], None, [256], [0, 256]).ravel()
+    clip_value = int(np.searchsorted(histogram.cumsum(), 0.0005 * corrected.size))
+    corrected = cv2.max(corrected, clip_value)
+    corrected = cv2.normalize(corrected, corrected, 0, 255, cv2.NORM_MINMAX)
+    return corrected, mask_large
+
+
+ILLUMINATION_CORRECTIONS = {
+    'percentile': threshold_makrers_illumanation,
+    'morphology': threshold_markers_illumination_morphology,
+}
+
+
+def correct_illumination(image: np.ndarray, method='morphology'):
+    """
+    Parameters
+    ----------
+    image : np.ndarray
+        Grayscale crop of the sheet
+    method : str
+        One of ``ILLUMINATION_CORRECTIONS``
+
+    Returns
+    -------
+    Tuple (corrected image, estimated paper brightness)
+    """
+    return ILLUMINATION_CORRECTIONS[method](image)
+
+
 def create_circular_mask(h, w, center=None, radius=None):
     if center is None:  # use the middle of the image
         center = (int(w / 2), int(h / 2))
@@ -206,26 +500,75 @@ def create_points_grid(x, y, n_rows, n_cols, r, h):
     return points
 
 
-def check_grid(image, grid, r):
-    r = int(r * 0.85)
-    mask_size = r * 2
-    mask = create_circular_mask(mask_size, mask_size, radius=r)
+def circle_row_extents(r):
+    """
+    Half-widths of the rows of the circular mask returned by
+    ``create_circular_mask(2 * r, 2 * r, radius=r)``.
 
-    hexs = []
-    image = image > 210  # TODO
-    for x, y in grid:
-        mini_image = image[y - r:y + r, x - r:x + r]
+    Returns
+    -------
+    Arrays (dy, left, right): row offsets from the center and the inclusive
+    column offsets of the first and the last pixel of every row.
+    """
+    dy = np.arange(-r, r)
+    half = np.floor(np.sqrt(np.maximum(r ** 2 - dy ** 2, 0))).astype(int)
+    return dy, -half, np.minimum(half, r - 1)
 
-        if min(mini_image.shape) < mask_size:  # TODO logging
-            hexs.append(False)
-            continue
-        # image[y - r: y + r, x - r: x + r] = image[y - r: y + r, x - r: x + r] * mask
-        if mini_image[mask].mean() < 0.975:  # TODO
-            hexs.append(True)
-        else:
-            hexs.append(False)
-    # plt.imshow(image)
-    return hexs
+
+def hex_occupancy(image, grid, r, threshold=210, empty_ratio=0.975):
+    """
+    Fill ratio of every hex computed in a single vectorized pass.
+
+    The binarized image is turned into an integral image, so the number of
+    dark pixels in a circle is a sum of ``2 * r`` row spans sampled at all
+    centers at once.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Grayscale image after illumination correction
+    grid : array-like
+        (N, 2) integer pixel coordinates of the hex centers
+    r : int
+        Radius of the sampled circle
+    threshold : int
+        Pixels darker than or equal to the threshold are considered ink
+    empty_ratio : float
+        Minimal share of blank pixels for a hex to be considered empty
+
+    Returns
+    -------
+    Tuple (ratios, occupied): per-hex share of ink pixels and the boolean
+    occupancy vector. Hexes whose circle is not fully inside the image are
+    reported with ratio 0 and as empty.
+    """
+    grid = np.asarray(grid, dtype=int).reshape(-1, 2)
+    h, w = image.shape[:2]
+
+    _, dark = cv2.threshold(image, threshold, 1, cv2.THRESH_BINARY_INV)
+    integral = cv2.integral(dark)
+
+    x, y = grid[:, 0], grid[:, 1]
+    inside = (x - r >= 0) & (y - r >= 0) & (x + r <= w) & (y + r <= h)
+
+    dy, left, right = circle_row_extents(r)
+    xs, ys = x[inside, None], y[inside, None] + dy
+    counts = (integral[ys + 1, xs + right + 1] - integral[ys, xs + right + 1]
+              - integral[ys + 1, xs + left] + integral[ys, xs + left]).sum(axis=1)
+    total = (right - left + 1).sum()
+
+    ratios = np.zeros(len(grid))
+    ratios[inside] = counts / total
+    occupied = np.zeros(len(grid), dtype=bool)
+    occupied[inside] = (total - counts) / total < empty_ratio
+
+    return ratios, occupied
+
+
+def check_grid(image, grid, r):
+    r = int(r * 0.85)
+    _, occupied = hex_occupancy(image, grid, r)
+    return occupied.tolist()
 
 
 def plot_hexes_by_class(image, grid, hex_classes, r, orientation='flat', ax=None,
@@ -238,17 +581,14 @@ def plot_hexes_by_class(image, grid, hex_classes, r, orientation='flat', ax=None
     elif orientation == 'pointy':
         orientation = 0
 
-    color_classes = ['blue', 'red', 'yellowgreen', 'purple', 'forestgreen',
-                     'darkorange', 'peru', 'gold', 'aqua', 'springgreen', 'firebrick'] * 2
-
     for h, (x, y) in zip(hex_classes, grid):
         if skip_empty and h == 0:
             continue
         hexagon = RegularPolygon((x, y), numVertices=6,
                                  radius=r, alpha=alpha,
-                                 edgecolor=color_classes[h],
+                                 edgecolor=class_color(h),
                                  orientation=orientation,
-                                 facecolor=color_classes[h])
+                                 facecolor=class_color(h))
         ax.add_patch(hexagon)
 
     if image is not None:
@@ -260,6 +600,52 @@ def plot_hexes_by_class(image, grid, hex_classes, r, orientation='flat', ax=None
         ax.set_aspect('equal')
 
 
+def hex_vertices(grid, r, orientation='flat'):
+    """
+    Vertices of the hexagons drawn by ``plot_hexes_by_class``.
+
+    Returns
+    -------
+    np.ndarray of shape (N, 6, 2)
+    """
+    start = np.pi if orientation == 'flat' else np.pi / 2
+    angles = start + np.arange(6) * np.pi / 3
+    offsets = r * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    return np.asarray(grid, dtype=float).reshape(-1, 1, 2) + offsets
+
+
+def draw_hexes_by_class(image, grid, hex_classes, r, orientation='flat', skip_empty=False, alpha=0.25):
+    """
+    Rasterizes translucent hexagons onto an RGB image with OpenCV.
+
+    Mirrors ``plot_hexes_by_class`` without matplotlib, so it is cheap and does
+    not touch pyplot global state.
+
+    Returns
+    -------
+    New RGB image with the hexagons blended in
+    """
+    shift = 4  # sub-pixel precision bits used by OpenCV drawing functions
+    hex_classes = np.asarray(hex_classes, dtype=int)
+    polygons = np.round(hex_vertices(grid, r, orientation) * 2 ** shift).astype(np.int32)
+
+    classes = [h for h in np.unique(hex_classes) if not (skip_empty and h == 0)]
+    colors = {h: tuple(int(c * 255) for c in to_rgb(class_color(h))) for h in classes}
+
+    # faces and edges are blended separately, like the face and the edge of a matplotlib patch
+    faces = image.copy()
+    for h in classes:
+        cv2.fillPoly(faces, list(polygons[hex_classes == h]), colors[h], lineType=cv2.LINE_AA, shift=shift)
+    image = cv2.addWeighted(faces, alpha, image, 1 - alpha, 0)
+
+    edges = image.copy()
+    for h in classes:
+        cv2.polylines(edges, list(polygons[hex_classes == h]), True, colors[h],
+                      thickness=1, lineType=cv2.LINE_AA, shift=shift)
+
+    return cv2.addWeighted(edges, alpha, image, 1 - alpha, 0)
+
+
 @dataclass(init=True)
 class DetectionStages:
     image: np.ndarray
@@ -273,6 +659,7 @@ class DetectionStages:
     points: list
     orientation: str
     transform: np.ndarray
+    timings: dict = field(default_factory=dict)
 
     def plot_decoding_debug(self) -> None:
         fig, axs = plt.subplots(1, 5, figsize=(20, 4))
@@ -312,4 +699,72 @@ class DetectionStages:
         ax.invert_yaxis()
         ax.axis('off')
 
-        return fig
\ No newline at end of file
+        return fig
+
+    def render_overlay(self, cropped=True, hex_scale=1, height=924, quality=90) -> bytes:
+        """
+        Renders the same overlay as ``plot_image_overlay`` with OpenCV and encodes it as JPEG.
+
+        Parameters
+        ----------
+        cropped : bool
+            Draw on the perspective-corrected sheet instead of the original photo
+        hex_scale : float
+            Scale of the drawn hexagons
+        height : int
+            Height of the output image in pixels. The default matches the axes of
+            the 12 inch matplotlib figure saved with 100 dpi.
+        quality : int
+            JPEG quality
+
+        Returns
+        -------
+        JPEG encoded image
+        """
+        return self.overlay_renderer(cropped, hex_scale, height, quality)()
+
+    def overlay_renderer(self, cropped=True, hex_scale=1, height=924, quality=90):
+        """
+        Scales the image to the output size of ``render_overlay`` and returns the rest
+        of the rendering as a function without arguments. The function keeps only
+        the output-sized image, not the full resolution ones.
+        """
+        if cropped:
+            shape = self.crop.shape
+            scale = height / shape[0]
+            size = (int(round(shape[1] * scale)), height)
+            # warp straight into the output resolution
+            transform = np.diag([scale, scale, 1]) @ self.transform
+            image = cv2.warpPerspective(self.image, transform, size)
+            points = np.asarray(self.points, dtype=float) * scale
+        else:
+            shape = self.image.shape
+            scale = height / shape[0]
+            size = (int(round(shape[1] * scale)), height)
+            image = cv2.resize(self.image, size, interpolation=cv2.INTER_AREA)
+            points = cv2.perspectiveTransform(np.array([self.points], dtype=np.float32),
+                                              np.linalg.inv(self.transform))[0] * scale
+
+        return partial(encode_overlay, image, points, np.array(self.hexes), self.r * hex_scale * scale,
+                       self.orientation, quality)
+
+
+def encode_overlay(image, points, hexes, r, orientation, quality=90) -> bytes:
+    overlay = draw_hexes_by_class(image, points, hexes, r=r, orientation=orientation, skip_empty=True, alpha=0.25)
+    _, encoded = cv2.imencode('.jpg', cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR),
+                              [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes()
+
+
+def test_draw_hexes_by_class():
+    # more players than colors in the palette
+    points = np.stack(np.meshgrid(np.arange(8), np.arange(5)), axis=-1).reshape(-1, 2) * 20 + 10
+    hex_classes = np.arange(len(points)) % 31
+    image = draw_hexes_by_class(np.zeros((110, 170, 3), dtype=np.uint8), points, hex_classes, r=8,
+                                skip_empty=True)
+    assert image.shape == (110, 170, 3) and image.any()
+    assert class_color(21) == COLOR_CLASSES[21] and class_color(22) == COLOR_CLASSES[1]
+
+
+if __name__ == '__main__':
+    test_draw_hexes_by_class()
@@ -18,3 +18,10 @@ class ARUCONotFoundException(Exception):
     def __str__(self):
         return "ARUCO not found"
 
+class QueueFullException(Exception):
+    def __str__(self):
+        return "Processing queue is full"
+
+class PlacementException(Exception):
+    def __str__(self):
+        return "Players do not fit on the grid, use a smaller grid size or fewer players"
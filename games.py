@@ -0,0 +1,68 @@
+import os
+import re
+import tempfile
+
+import numpy as np
+
+UUID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class GameStore:
+    """
+    Per-game files kept between uploads, keyed by the uuid from the QR code.
+
+    ``<uuid>.npz`` holds the last evaluated state of the sheet: the occupancy of the
+    hexes (start hexes included) and the labels of the occupied regions.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the files, created if missing
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, uuid, extension):
+        # the uuid comes from the photo, never let it point outside the directory
+        if not UUID_PATTERN.match(str(uuid)):
+            return None
+
+        return os.path.join(self.directory, f"{uuid}.{extension}")
+
+    def _write(self, path, write):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # concurrent uploads of the same game must never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=os.path.splitext(path)[1])
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def load_state(self, uuid):
+        """
+        Returns
+        -------
+        Tuple (occupancy, labels) of the last evaluation, None if there is none
+        """
+        path = self.path(uuid, 'npz')
+        if path is None or not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as state:
+                return state['occupied'], state['labels']
+        except Exception as e:
+            print(f"Can't load the state of {uuid}: {e}")
+            return None
+
+    def save_state(self, uuid, occupied, labels):
+        path = self.path(uuid, 'npz')
+        if path is None:
+            return
+
+        self._write(path, lambda f: np.savez(f, occupied=occupied, labels=labels))
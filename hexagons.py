@@ -1,7 +1,11 @@
+import copy
 from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
 
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy import ndimage
 
 from hexlib import *
 
@@ -23,13 +27,16 @@ def get_layout(orientation="flat", size=size, start_position=(0, 0)):
 
 
 class Hexagon:
-    def __init__(self, q, r, s, grid=None):
+    __slots__ = ('q', 'r', 's', 'grid', 'index')
+
+    def __init__(self, q, r, s, grid=None, index=None):
         assert not (round(q + r + s) != 0), "q + r + s must be 0"
 
         self.q = q
         self.r = r
         self.s = s
         self.grid = grid
+        self.index = index  # position in grid.hexs
 
     def __add__(self, other):
 
@@ -47,8 +54,9 @@ class Hexagon:
             grid = None
 
         if grid is not None:
-            if q in grid.hexs_dict and r in grid.hexs_dict[q]:
-                return grid[q, r]
+            index = grid.index_of(q, r)
+            if index >= 0:
+                return grid.hexs[index]
 
         return Hexagon(q, r, s, None)
 
@@ -61,18 +69,17 @@ class Hexagon:
     def __repr__(self):
         return f"Hexagon(q={self.q}, r={self.r}, s={self.s}, grid={self.grid})"
 
+    @property
+    def border_dist(self):
+        return int(self.grid.border_dist[self.index])
+
     @property
     def neigs(self):
-        hex_directions = [
-            Hexagon(1, 0, -1),
-            Hexagon(1, -1, 0),
-            Hexagon(0, -1, 1),
-            Hexagon(-1, 0, 1),
-            Hexagon(-1, 1, 0),
-            Hexagon(0, 1, -1)
-        ]
+        if self.grid is None:
+            return ()
 
-        return [self + i for i in hex_directions if (self + i).grid]
+        hexs = self.grid.hexs
+        return tuple(hexs[i] for i in self.grid.neighbor_lists[self.index])
 
     @staticmethod
     def dist(a, b):
@@ -121,26 +128,101 @@ class Hexagon:
         return np.array([np.array([x]*9) + x_shifts, np.array([y]*9) + y_shifts]).T.tolist()
 
 
+# neighborhood of a cell of the (q, r) raster, see ``hex_directions``
+AXIAL_STRUCTURE = np.array([[0, 1, 1],
+                            [1, 1, 1],
+                            [1, 1, 0]])
+
+
+@dataclass
+class Territories:
+    """
+    Connected regions of occupied hexagons and the players they belong to.
+
+    occupied : occupied hexagons, including the start hexagons
+    labels : region of every hexagon (1..n_regions), 0 for the empty ones
+    owners : player owning every region (index 0 is the background), -1 if no
+        player starts in it
+    players : player of every hexagon, -1 for the empty and unassigned ones
+    components : indices of the hexagons of every player, in ascending order
+    unassigned : indices of the hexagons of every region without a player
+    """
+    occupied: np.ndarray
+    labels: np.ndarray
+    owners: np.ndarray
+    players: np.ndarray
+    components: list
+    unassigned: list
+
+    @property
+    def n_regions(self):
+        return len(self.owners) - 1
+
+
 class HexagonsGrid:
+    """
+    Struct-of-arrays hexagonal grid.
+
+    The geometry is immutable after construction and stored in arrays indexed by
+    the position of the hexagon in ``hexs``: axial coordinates ``q`` and ``r``,
+    ``border_dist`` and the ``neighbors`` table ((N, 6) indices in the order of
+    ``hex_directions``, -1 outside the grid). (q, r) are mapped to indices by an
+    offset array. ``hexs`` are thin ``Hexagon`` views on it.
+
+    The mutable per-hexagon state lives in the ``flag`` and ``color`` arrays, so
+    ``copy`` gives a cheap independent grid sharing the geometry.
+    """
+
     def __init__(self, orientation='flat', size=5, start_pos=(0, 0), corners=((0, 0), (210, 297))):
 
         self.size = size
         self.layout = get_layout(orientation=orientation, size=size, start_position=start_pos)
         self.corners = corners
 
-        self.hexs = [Hexagon(_hex.q, _hex.r, -_hex.q - _hex.r, self) for _hex in self.gen_hexs()]
-        self.hexs_dict = {}
+        hexs = self.gen_hexs()
+        self.q = np.array([_hex.q for _hex in hexs], dtype=np.int32)
+        self.r = np.array([_hex.r for _hex in hexs], dtype=np.int32)
 
-        for _hex in self.hexs:
-            self.hexs_dict[_hex.q] = {}
+        self.q_min, self.r_min = int(self.q.min()), int(self.r.min())
+        self._index = np.full((self.q.max() - self.q_min + 1, self.r.max() - self.r_min + 1), -1, dtype=np.int32)
+        self._index[self.q - self.q_min, self.r - self.r_min] = np.arange(len(hexs))
 
-        for _hex in self.hexs:
-            self.hexs_dict[_hex.q][_hex.r] = _hex
-            _hex.flag = 0
-            _hex.color = 0
+        self.neighbors = np.stack([self.index_of(self.q + d.q, self.r + d.r) for d in hex_directions], axis=1)
+
+        # the hexagons and the adjacency rows share the int objects of the indices
+        indices = list(range(len(hexs)))
+        self.hexs = [Hexagon(int(q), int(r), int(-q - r), self, index)
+                     for index, q, r in zip(indices, self.q.tolist(), self.r.tolist())]
+
+        # adjacency as plain tuples for the traversals, so they do not touch numpy scalars
+        self.neighbor_lists = [tuple(indices[i] for i in row if i >= 0) for row in self.neighbors.tolist()]
+
+        self.flag = np.zeros(len(self.hexs), dtype=np.uint8)
+        self.color = np.zeros(len(self.hexs), dtype=np.uint8)
 
         self.calculate_border_distances()
 
+    def copy(self):
+        """
+        Grid sharing the geometry with this one, with its own clean flag/color state.
+        """
+        grid = copy.copy(self)
+        grid.flag = np.zeros_like(self.flag)
+        grid.color = np.zeros_like(self.color)
+        return grid
+
+    def index_of(self, q, r):
+        """
+        Indices of the hexagons with axial coordinates ``q``, ``r`` (scalars or
+        arrays), -1 for the ones outside the grid.
+        """
+        i = np.asarray(q) - self.q_min
+        j = np.asarray(r) - self.r_min
+        inside = (i >= 0) & (i < self._index.shape[0]) & (j >= 0) & (j < self._index.shape[1])
+        index = np.where(inside, self._index[np.where(inside, i, 0), np.where(inside, j, 0)], -1)
+
+        return int(index) if index.ndim == 0 else index
+
     def gen_hexs(self):
         layout = self.layout
         p1, p2 = self.corners
@@ -176,18 +258,14 @@ class HexagonsGrid:
         return hexs
 
     def get_polygons(self, loop=False):
-        hexs = self.hexs
-
-        polygons = [h.get_polygon(loop=loop) for h in hexs]
+        polygons = polygon_corners_batch(self.layout, self.q, self.r)
+        if loop:
+            polygons = np.concatenate([polygons, polygons[:, :1]], axis=1)
 
         return polygons
 
     def get_centers(self):
-        hexs = self.hexs
-
-        centers = [h.get_center() for h in hexs]
-
-        return centers
+        return hex_to_pixel_batch(self.layout, self.q, self.r)
 
     def get_crosses(self):
         hexs = self.hexs
@@ -209,12 +287,31 @@ class HexagonsGrid:
         else:
             raise IndexError("Incorrect Index")
 
-        return self.hexs_dict[q][r]
+        index = self.index_of(q, r)
+        if index < 0:
+            raise KeyError((q, r))
+
+        return self.hexs[index]
 
     def get_hexagon_by_coord(self, x, y):
         h = hex_round(pixel_to_hex(self.layout, Point(x, y)))
 
-        return self.hexs_dict[h.q][h.r]
+        return self[h.q, h.r]
+
+    def get_indices_by_coords(self, points):
+        """
+        Indices of the hexagons containing every point of an (N, 2) array of pixel
+        coordinates, -1 for the points outside the grid.
+        """
+        q, r, _ = hex_round_batch(*pixel_to_hex_batch(self.layout, points))
+
+        return self.index_of(q, r)
+
+    def get_hexagons_by_coords(self, points):
+        """
+        Hexagons containing every point of an (N, 2) array of pixel coordinates.
+        """
+        return [self.hexs[i] for i in self.get_indices_by_coords(points)]
 
     def draw(self, color=None, alpha=1):
         coords = np.array(self.get_polygons(loop=True))
@@ -234,46 +331,304 @@ class HexagonsGrid:
         plt.plot(crosses[:, :, 0].T, crosses[:, :, 1].T, color=color, alpha=alpha)
 
     def bfs(self, h, clean=False):
-        hexs = []
+        """
+        Connected component of flagged hexagons reachable from ``h``.
+        Visited hexagons are marked in ``color``.
+        """
+        neighbors = self.neighbor_lists
+        flag = self.flag.tolist()
+        color = self.color.tolist()
+
+        visited = []
         q = deque()
-        h.color = 1
-        q.append(h)
+        color[h.index] = 1
+        q.append(h.index)
 
         while len(q) != 0:
-            h = q.popleft()
-            hexs.append(h)
-            for neig in h.neigs:
-                if neig.color == 0 and neig.flag == 1:
-                    neig.color = 1
+            i = q.popleft()
+            visited.append(i)
+            for neig in neighbors[i]:
+                if color[neig] == 0 and flag[neig] == 1:
+                    color[neig] = 1
                     q.append(neig)
 
-        if clean:
-            for h in hexs:
-                h.color = 0
-
-        return hexs
+        if not clean:
+            self.color[visited] = 1
+
+        return [self.hexs[i] for i in visited]
+
+    def label_components(self, occupied):
+        """
+        Labels the connected regions of occupied hexagons in one pass.
+
+        Parameters
+        ----------
+        occupied : boolean array, one value per hexagon
+
+        Returns
+        -------
+        Tuple (label of every hexagon, 0 for the empty ones, number of regions).
+        Regions are numbered in the order of their first hexagon on the (q, r) raster.
+        """
+        raster = np.zeros(self._index.shape, dtype=bool)
+        raster[self.q - self.q_min, self.r - self.r_min] = occupied
+        labels, n = ndimage.label(raster, structure=AXIAL_STRUCTURE)
+
+        return labels[self.q - self.q_min, self.r - self.r_min], n
+
+    def label_added(self, labels, added):
+        """
+        Updates the labels of ``label_components`` after the ``added`` hexagons got
+        occupied. Only the added hexagons and their neighbours are visited, the
+        regions they connect are merged with union-find.
+
+        Returns
+        -------
+        Same as ``label_components`` for the new occupancy, with the same numbering
+        """
+        labels = np.array(labels)
+        parent = list(range(int(labels.max(initial=0)) + 1))
+
+        def find(label):
+            while parent[label] != label:
+                parent[label] = parent[parent[label]]
+                label = parent[label]
+            return label
+
+        for i in np.asarray(added, dtype=int).tolist():
+            if labels[i] != 0:
+                continue
+
+            roots = {find(int(labels[j])) for j in self.neighbor_lists[i] if labels[j] != 0}
+            if len(roots) == 0:
+                parent.append(len(parent))
+                labels[i] = len(parent) - 1
+            else:
+                root = min(roots)
+                for other in roots:
+                    parent[other] = root
+                labels[i] = root
+
+        labels = np.array([find(label) for label in range(len(parent))])[labels]
+
+        # number the regions in the order of their first hexagon, as ndimage.label does
+        # (hexagons are stored in the raster order)
+        present, first = np.unique(labels, return_index=True)
+        present, first = present[present != 0], first[present != 0]
+        numbering = np.zeros(len(parent), dtype=labels.dtype)
+        numbering[present[np.argsort(first)]] = np.arange(1, len(present) + 1)
+
+        return numbering[labels], len(present)
+
+    def update_territories(self, starts, occupied, previous_occupied=None, previous_labels=None) -> Territories:
+        """
+        Same as ``territories``, reusing the labels of the previous evaluation of the
+        same sheet when hexagons were only added since then. Falls back to labeling
+        the whole grid when there is no previous state or some crosses disappeared.
+        """
+        starts = np.asarray(starts, dtype=int).reshape(-1)
+        occupied = np.array(occupied, dtype=bool)
+        occupied[starts] = True
+
+        if previous_occupied is None or len(previous_occupied) != len(self) \
+                or np.any(previous_occupied & ~occupied):
+            return self.territories(starts, occupied)
+
+        labels = self.label_added(previous_labels, np.flatnonzero(occupied & ~previous_occupied))
+        return self.territories(starts, occupied, labels=labels)
+
+    def territories(self, starts, occupied, labels=None) -> Territories:
+        """
+        Splits the occupied hexagons between the players.
+
+        A player gets the whole region containing its start hexagon (start hexagons
+        count as occupied). When several players start in the same region it belongs
+        to the first of them, the others get only their start hexagon. Neither
+        ``flag`` nor ``color`` is used.
+
+        Parameters
+        ----------
+        starts : indices of the start hexagons of the players
+        occupied : boolean array, one value per hexagon
+        labels : result of ``label_components`` for the occupancy, if already known
+        """
+        starts = np.asarray(starts, dtype=int).reshape(-1)
+        occupied = np.array(occupied, dtype=bool)
+        occupied[starts] = True
+
+        labels, n = labels if labels is not None else self.label_components(occupied)
+
+        # hexagons grouped by region
+        order = np.argsort(labels, kind='stable')
+        regions = np.split(order, np.cumsum(np.bincount(labels, minlength=n + 1))[:-1])
+
+        owners = np.full(n + 1, -1)
+        start_labels = labels[starts]
+        owned, first = np.unique(start_labels, return_index=True)
+        owners[owned] = first
+
+        players = owners[labels]
+        players[labels == 0] = -1
+        shared = owners[start_labels] != np.arange(len(starts))
+        players[starts[shared]] = np.flatnonzero(shared)
+
+        components = [regions[label] if not is_shared else starts[[player]]
+                      for player, (label, is_shared) in enumerate(zip(start_labels, shared))]
+        unassigned = [regions[label] for label in np.flatnonzero(owners[1:] < 0) + 1]
+
+        return Territories(occupied=occupied, labels=labels, owners=owners, players=players,
+                           components=components, unassigned=unassigned)
+
+    def distance_fields(self, components):
+        """
+        Hex distances from every hexagon to the nearest hexagon of every component.
+
+        Parameters
+        ----------
+        components : list of non-empty arrays of hexagon indices
+
+        Returns
+        -------
+        (len(components), N) int array
+        """
+        if len(components) == 0:
+            return np.zeros((0, len(self)), dtype=int)
+
+        cells = np.concatenate(components)
+        starts = np.cumsum([0] + [len(component) for component in components[:-1]])
+
+        dq = self.q[:, None] - self.q[cells]
+        dr = self.r[:, None] - self.r[cells]
+        distances = np.maximum(np.maximum(np.abs(dq), np.abs(dr)), np.abs(dq + dr))
+
+        return np.minimum.reduceat(distances, starts, axis=1).T
 
     def clean(self):
-        for _hex in self.hexs:
-            _hex.flag = 0
-            _hex.color = 0
+        self.flag[:] = 0
+        self.color[:] = 0
 
     def calculate_border_distances(self):
-        self.clean()
-        q = deque()
+        self.border_dist = np.full(len(self.q), -1, dtype=np.int16)
+        frontier = np.flatnonzero((self.neighbors < 0).any(axis=1))
+        distance = 0
 
-        for h in self.hexs:
-            if len(h.neigs) < 6:
-                h.border_dist = 0
-                h.color = 1
-                q.append(h)
+        while len(frontier) != 0:
+            self.border_dist[frontier] = distance
+            neigs = self.neighbors[frontier].ravel()
+            neigs = np.unique(neigs[neigs >= 0])
+            frontier = neigs[self.border_dist[neigs] < 0]
+            distance += 1
+
+
+@lru_cache(maxsize=16)
+def _grid_template(orientation, size, start_pos, corners):
+    return HexagonsGrid(orientation=orientation, size=size, start_pos=start_pos, corners=corners)
+
+
+def cached_grid(orientation='flat', size=5, start_pos=(0, 0), corners=((0, 0), (210, 297))):
+    """
+    Same as ``HexagonsGrid(...)``, but the geometry is built once per set of
+    parameters and shared, only the flag/color state is new.
+    """
+    start_pos = tuple(start_pos)
+    corners = tuple(tuple(corner) for corner in corners)
+    return _grid_template(orientation, size, start_pos, corners).copy()
+
+
+def sheet_test_grid():
+    # grid of the A4 sheet with grid_size=3
+    return cached_grid(orientation='pointy', size=300, start_pos=(1500, 7500), corners=((1500, 7500), (19500, 28200)))
+
+
+def random_starts(grid, n, rng):
+    return rng.choice(np.flatnonzero(grid.border_dist >= 2), size=n, replace=False)
+
+
+def test_territories(trials=20):
+    rng = np.random.RandomState(0)
+    grid = sheet_test_grid()
+
+    for _ in range(trials):
+        starts = random_starts(grid, rng.randint(1, 12), rng)
+        occupied = rng.rand(len(grid)) < rng.uniform(0.05, 0.5)
+        result = grid.territories(starts, occupied)
+
+        # one bfs per player, in the order of the players
+        grid.clean()
+        grid.flag[:] = result.occupied
+        for player, start in enumerate(starts):
+            expected = sorted(h.index for h in grid.bfs(grid.hexs[start]))
+            assert sorted(result.components[player].tolist()) == expected
+            # the start hexagons of the players sharing the region stay theirs
+            assert result.players[start] == player
+            assert np.all(result.players[np.setdiff1d(expected, starts)] == player)
+
+        assigned = set(np.concatenate(result.components).tolist())
+        unassigned = set(np.concatenate(result.unassigned or [[]]).astype(int).tolist())
+        assert assigned | unassigned == set(np.flatnonzero(result.occupied).tolist())
+        assert not assigned & unassigned
+
+
+def test_distance_fields(trials=3):
+    rng = np.random.RandomState(1)
+    grid = sheet_test_grid()
+
+    for _ in range(trials):
+        components = [rng.choice(len(grid), size=rng.randint(1, 10), replace=False) for _ in range(rng.randint(1, 4))]
+        fields = grid.distance_fields(components)
+
+        for component, field in zip(components, fields):
+            expected = [min(Hexagon.dist(h, grid.hexs[i]) for i in component) for h in grid.hexs]
+            assert field.tolist() == expected
+
+    assert grid.distance_fields([]).shape == (0, len(grid))
+
+
+def test_label_added(trials=50):
+    rng = np.random.RandomState(2)
+    grid = sheet_test_grid()
+
+    for _ in range(trials):
+        occupied = rng.rand(len(grid)) < rng.uniform(0, 0.5)
+        labels, _ = grid.label_components(occupied)
+
+        # a few uploads of the same sheet, crosses are only added
+        for _ in range(3):
+            added = np.flatnonzero(~occupied & (rng.rand(len(grid)) < rng.uniform(0, 0.2)))
+            occupied = occupied.copy()
+            occupied[added] = True
+
+            labels, n = grid.label_added(labels, rng.permutation(added))
+            expected, expected_n = grid.label_components(occupied)
+            assert n == expected_n and np.array_equal(labels, expected)
+
+
+def test_update_territories(trials=20):
+    rng = np.random.RandomState(3)
+    grid = sheet_test_grid()
+
+    for _ in range(trials):
+        starts = random_starts(grid, rng.randint(1, 12), rng)
+        previous = grid.territories(starts, rng.rand(len(grid)) < rng.uniform(0, 0.4))
+
+        occupied = previous.occupied | (rng.rand(len(grid)) < rng.uniform(0, 0.2))
+        if rng.rand() < 0.3:
+            # some crosses were erased
+            occupied &= rng.rand(len(grid)) > 0.05
+
+        result = grid.update_territories(starts, occupied, previous.occupied, previous.labels)
+        expected = grid.territories(starts, occupied)
+        assert np.array_equal(result.labels, expected.labels)
+        assert np.array_equal(result.players, expected.players)
+        assert all(np.array_equal(a, b) for a, b in zip(result.components, expected.components))
+
+
+def test_all():
+    test_territories()
+    test_distance_fields()
+    test_label_added()
+    test_update_territories()
 
-        while len(q) != 0:
-            h = q.popleft()
-            for neig in h.neigs:
-                if neig.color == 0:
-                    neig.color = 1
-                    neig.border_dist = h.border_dist + 1
-                    q.append(neig)
 
-        self.clean()
+if __name__ == '__main__':
+    test_all()
@@ -4,6 +4,8 @@ from __future__ import print_function
 import collections
 import math
 
+import numpy as np
+
 
 Point = collections.namedtuple("Point", ["x", "y"])
 _Hex = collections.namedtuple("Hex", ["q", "r", "s"])
@@ -206,6 +208,60 @@ def polygon_corners(layout, h):
     return corners
 
 
+# Batch versions working on numpy arrays of coordinates
+
+
+def hex_to_pixel_batch(layout, q, r):
+    """Pixel centers of the hexes with axial coordinates ``q``, ``r`` as an (N, 2) array."""
+    M = layout.orientation
+    size = layout.size
+    origin = layout.origin
+    q = np.asarray(q, dtype=float)
+    r = np.asarray(r, dtype=float)
+    x = (M.f0 * q + M.f1 * r) * size.x
+    y = (M.f2 * q + M.f3 * r) * size.y
+    return np.stack([x + origin.x, y + origin.y], axis=-1)
+
+
+def pixel_to_hex_batch(layout, points):
+    """Fractional cube coordinates (q, r, s) of an (N, 2) array of pixels."""
+    M = layout.orientation
+    size = layout.size
+    origin = layout.origin
+    points = np.asarray(points, dtype=float)
+    x = (points[..., 0] - origin.x) / size.x
+    y = (points[..., 1] - origin.y) / size.y
+    q = M.b0 * x + M.b1 * y
+    r = M.b2 * x + M.b3 * y
+    return q, r, -q - r
+
+
+def hex_round_batch(q, r, s):
+    """Same as ``hex_round`` (including tie-breaking) for arrays of fractional coordinates."""
+    q = np.asarray(q, dtype=float)
+    r = np.asarray(r, dtype=float)
+    s = np.asarray(s, dtype=float)
+    qi = np.round(q)
+    ri = np.round(r)
+    si = np.round(s)
+    q_diff = np.abs(qi - q)
+    r_diff = np.abs(ri - r)
+    s_diff = np.abs(si - s)
+    fix_q = (q_diff > r_diff) & (q_diff > s_diff)
+    fix_r = ~fix_q & (r_diff > s_diff)
+    fix_s = ~fix_q & ~fix_r
+    qi = np.where(fix_q, -ri - si, qi)
+    ri = np.where(fix_r, -qi - si, ri)
+    si = np.where(fix_s, -qi - ri, si)
+    return qi.astype(int), ri.astype(int), si.astype(int)
+
+
+def polygon_corners_batch(layout, q, r):
+    """Corners of the hexes with axial coordinates ``q``, ``r`` as an (N, 6, 2) array."""
+    offsets = np.array([hex_corner_offset(layout, i) for i in range(0, 6)])
+    return hex_to_pixel_batch(layout, q, r)[..., None, :] + offsets
+
+
 # Tests
 
 def complain(name):
@@ -332,6 +388,50 @@ def test_doubled_to_cube():
     equal_hex("doubled_to_cube doubled-r", Hex(1, 2, -3), rdoubled_to_cube(DoubledCoord(4, 2)))
 
 
+def test_layout_batch():
+    q, r = np.meshgrid(np.arange(-5, 6), np.arange(-7, 4))
+    q, r = q.ravel(), r.ravel()
+    for orientation in (layout_flat, layout_pointy):
+        layout = Layout(orientation, Point(10.0, 15.0), Point(35.0, 71.0))
+        pixels = hex_to_pixel_batch(layout, q, r)
+        corners = polygon_corners_batch(layout, q, r)
+        fractional = pixel_to_hex_batch(layout, pixels + [3.0, -2.0])
+        for i in range(len(q)):
+            h = Hex(q[i], r[i], -q[i] - r[i])
+            if not np.allclose(pixels[i], hex_to_pixel(layout, h)):
+                complain("hex_to_pixel_batch")
+            if not np.allclose(corners[i], polygon_corners(layout, h)):
+                complain("polygon_corners_batch")
+            p = pixel_to_hex(layout, Point(pixels[i][0] + 3.0, pixels[i][1] - 2.0))
+            if not np.allclose([f[i] for f in fractional], [p.q, p.r, p.s]):
+                complain("pixel_to_hex_batch")
+
+
+def test_hex_round_batch():
+    a = Hex(0.0, 0.0, 0.0)
+    b = Hex(1.0, -1.0, 0.0)
+    c = Hex(0.0, -1.0, 1.0)
+    hexes = [
+        hex_lerp(Hex(0.0, 0.0, 0.0), Hex(10.0, -20.0, 10.0), 0.5),
+        hex_lerp(a, b, 0.499),
+        hex_lerp(a, b, 0.501),
+        hex_lerp(a, b, 0.5),  # ties
+        hex_lerp(a, c, 0.5),
+        hex_lerp(b, c, 0.5),
+        Hex(0.5, 0.5, -1.0),
+        Hex(-0.5, 2.5, -2.0),
+        Hex(1 / 3, 1 / 3, -2 / 3),
+    ]
+    rng = np.random.RandomState(0)
+    for q, r in rng.uniform(-10, 10, size=(1000, 2)):
+        hexes.append(Hex(q, r, -q - r))
+    for q, r in rng.randint(-20, 20, size=(200, 2)) / 2:
+        hexes.append(Hex(q, r, -q - r))
+
+    rounded = hex_round_batch([h.q for h in hexes], [h.r for h in hexes], [h.s for h in hexes])
+    equal_hex_array("hex_round_batch", [hex_round(h) for h in hexes], [Hex(*h) for h in zip(*rounded)])
+
+
 def test_all():
     test_hex_arithmetic()
     test_hex_direction()
@@ -349,6 +449,8 @@ def test_all():
     test_doubled_roundtrip()
     test_doubled_from_cube()
     test_doubled_to_cube()
+    test_layout_batch()
+    test_hex_round_batch()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+import gc
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from uuid import uuid4
+
+from matplotlib import font_manager
+
+import detection
+from coffeegame import CoffeeGame
+from exceptions import QueueFullException
+
+# photo of a printed sheet used to warm up the pipeline
+WARMUP_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'documents', 'warmup_sheet.jpg')
+
+
+def warm_up(image_path=WARMUP_IMAGE):
+    """
+    Initializes everything the pipeline creates lazily (OpenCV and zbar state, ArUco
+    dictionaries, matplotlib font caches, the QR thread pool) by running the sample
+    image through ``proceed_image`` and rendering its overlay.
+    """
+    start = perf_counter()
+    font_manager.findfont(font_manager.FontProperties(family=['Courier', 'sans-serif']))
+    detection.sheet_aruco_dictionary()
+
+    try:
+        detection_stages = CoffeeGame().proceed_image(image_path)
+        detection_stages.render_overlay()
+    except Exception as e:
+        print(f"Warm up failed: {e}")
+
+    print(f"{perf_counter() - start:.2f}s - Warm up")
+
+
+def process_image(image_key, storage, store=None, roster=None, insert_rows=None):
+    """
+    Runs the recognition pipeline on an upload kept in the ``storage`` and puts the
+    overlay to it. Executed in a worker process, ``store`` and ``roster`` are passed
+    to ``proceed_image``, ``insert_rows`` inserts the ``Image`` row of the upload
+    (like the rows of ``BackgroundWriter``).
+
+    Returns
+    -------
+    Dictionary with the statistics and the overlay url
+    """
+    cg = CoffeeGame()
+    detection_stages = cg.proceed_image(storage.path(image_key), store=store, roster=roster)
+    overlay_key = storage.put(detection_stages.render_overlay(), 'overlays', '.jpg')
+
+    if insert_rows is not None:
+        try:
+            insert_rows([{"uuid": cg.uuid, "image": image_key, "config": cg.export_config()}])
+        except Exception as e:
+            print(f"Can't insert the image row of {image_key}: {e}")
+
+    return {
+        "statistics": cg.get_number_of_cups(),
+        "violations": cg.get_violations(),
+        "delta": cg.get_delta(),
+        "overlay_image": f"/files/{overlay_key}"
+    }
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs executed by a pool of worker processes.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes, the number of cores by default
+    max_pending : int
+        Maximal number of queued and running jobs, ``submit`` raises
+        ``QueueFullException`` when it is reached
+    max_finished : int
+        Number of finished jobs whose results are kept for polling
+    initializer : callable
+        Called in every worker process after it is started
+    start_method : str
+        ``fork`` by default. A ``forkserver`` pool does not inherit anything from
+        the current process, so it can be started after other threads are running.
+
+    ``start`` forks all the workers at once and should be called at startup, before
+    the process starts other threads. With a ``warmup_image`` the current process is
+    warmed up first, so the workers start warm and share the initialized state
+    copy-on-write.
+    """
+
+    def __init__(self, workers=None, max_pending=None, max_finished=1000, initializer=None, start_method='fork'):
+        self.workers = workers or os.cpu_count()
+        self.initializer = initializer
+        self.start_method = start_method
+        self.max_pending = max_pending or 4 * self.workers
+        self.max_finished = max_finished
+
+        self._slots = BoundedSemaphore(self.max_pending)
+        self._lock = Lock()
+        self._jobs = OrderedDict()
+        self._executor = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context(self.start_method),
+                                                     initializer=self.initializer)
+            return self._executor
+
+    def start(self, warmup_image=WARMUP_IMAGE):
+        """
+        Warms up the current process (unless ``warmup_image`` is None) and forks all
+        the workers.
+        """
+        if warmup_image is not None:
+            warm_up(warmup_image)
+            # fork a single-threaded process
+            detection.qr_cascade.shutdown()
+
+        # keep the warmed objects out of the garbage collector, so collections in the
+        # workers do not touch (and copy) the shared pages
+        gc.collect()
+        gc.freeze()
+
+        executor = self.executor
+        wait([executor.submit(os.getpid) for _ in range(self.workers)])
+
+    def submit(self, fn, *args) -> str:
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullException
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+
+        job_id = uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = future
+            self._forget_finished()
+
+        return job_id
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, future in self._jobs.items() if future.done()]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job_id]
+
+    def status(self, job_id) -> dict:
+        """
+        Returns
+        -------
+        Dictionary with the status of the job (``queued``, ``running``, ``done`` or
+        ``failed``) and, for finished jobs, the result or the error message.
+        None if the job is unknown.
+        """
+        with self._lock:
+            future = self._jobs.get(job_id)
+
+        if future is None:
+            return None
+
+        if not future.done():
+            return {"status": "running" if future.running() else "queued"}
+
+        exception = future.exception()
+        if exception is not None:
+            return {"status": "failed", "error": "true", "message": str(exception)}
+
+        return {"status": "done", **future.result()}
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
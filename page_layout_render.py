@@ -1,9 +1,10 @@
+import copy
+from functools import lru_cache
+
 import numpy as np
 from cv2 import aruco
-import matplotlib.pyplot as plt
 from pathlib import Path
-from hexagons import HexagonsGrid
-from pdfrw import PageMerge, PdfReader, PdfWriter
+from hexagons import cached_grid
 from fpdf import FPDF, HTMLMixin
 import qrcode
 
@@ -14,131 +15,69 @@ pf = 100  # pixel factor (how many pixels in one mm)
 pd = 5  # padding in mm
 header_size = 55  # height fo the header in mm
 corner_aruco_size = 8  # size of the corner aruco markers in mm
+pt = 72 / 25.4  # points in one mm
 
 
-def create_hex_grid(grid_size=5, orientation='pointy', ax=None):
-    if ax is None:
-        ax = plt.gca()
-
-    hex_grid = HexagonsGrid(orientation=orientation, size=grid_size * pf,
-                            start_pos=((pd + 10) * pf, (header_size + pd + 15) * pf),
-                            corners=(((pd + 10) * pf, (header_size + pd + 15) * pf),
-                                     ((w - pd - 10) * pf, (h - pd - 15) * pf)))
-    q = np.array(hex_grid.get_polygons(loop=True))
-    ax.plot(q[:, :, 0].T, q[:, :, 1].T, color='gainsboro', zorder=1)
-    return hex_grid
+def sheet_grid(grid_size=5, orientation='pointy'):
+    return cached_grid(orientation=orientation, size=grid_size * pf,
+                       start_pos=((pd + 10) * pf, (header_size + pd + 15) * pf),
+                       corners=(((pd + 10) * pf, (header_size + pd + 15) * pf),
+                                ((w - pd - 10) * pf, (h - pd - 15) * pf)))
 
 
-def plot_aruco(i, x, y, size, ax=None):
+@lru_cache(maxsize=64)
+def aruco_runs(i):
     """
-
-    Parameters
-    ----------
-    ax
-    i
-    x
-    y
-    size: Float
-        Size in mm
+    Black cells of the ArUco marker ``i`` (border included) as horizontal runs.
 
     Returns
     -------
-
+    Tuple (number of cells per side, tuple of runs (row, first column, length))
     """
-    if ax is None:
-        ax = plt.gca()
     aruco_dict = aruco.Dictionary_get(aruco.DICT_ARUCO_ORIGINAL)
-    aruco_img = aruco.drawMarker(aruco_dict, i, size * pf)
-    ax.imshow(aruco_img, extent=(x * pf, (x + size) * pf, (y + size) * pf, y * pf),
-              cmap='Greys_r', zorder=5, interpolation='none')
-
-
-def draw_random_markers(hex_grid, ax=None):
-    if ax is None:
-        ax = plt.gca()
-
-    q = np.array(hex_grid.get_polygons(loop=True))
-    qc = np.array(hex_grid.get_centers())
+    cells = aruco_dict.markerSize + 2
+    # one pixel per cell
+    black = aruco.drawMarker(aruco_dict, i, cells) == 0
 
-    n_participants = 8
-    participant_aruco_size = 5
-    ids = q.shape[0]
-    rng = np.random.RandomState(seed=42)
-    selected = rng.choice(np.arange(ids), n_participants, replace=False)
-    for i in range(n_participants):
-        plot_aruco(i + 10, (qc[selected[i], 0] / pf - participant_aruco_size / 2),
-                   (qc[selected[i], 1] / pf - participant_aruco_size / 2),
-                   size=participant_aruco_size)
-        ax.fill(q[selected[i], :, 0].T, q[selected[i], :, 1].T, color='gainsboro', zorder=0)
+    runs = []
+    for row in range(cells):
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], black[row].astype(int), [0]])))
+        runs += [(row, start, end - start) for start, end in zip(edges[::2], edges[1::2])]
 
+    return cells, tuple(runs)
 
-def draw_markers(hex_grid, players, ax=None):
-    if ax is None:
-        ax = plt.gca()
-
-    participant_aruco_size = 5
-
-    for p in players:
-        hex = hex_grid[p['coords'][0], p['coords'][1]]
-        center = hex.get_center()
-        vertices = np.array(hex.get_polygon(loop=True))
-        plot_aruco(10, (center[0] / pf - participant_aruco_size / 2),
-                   (center[1] / pf - participant_aruco_size / 2),
-                   size=participant_aruco_size)
-        ax.fill(vertices[:, 0], vertices[:, 1], color='gainsboro', zorder=0)
 
+class PDF(FPDF, HTMLMixin):
+    pass
 
-def draw_initials(hex_grid, players, ax=None):
-    if ax is None:
-        ax = plt.gca()
 
-    for p in players:
-        hex = hex_grid[p['coords'][0], p['coords'][1]]
-        center = hex.get_center()
-        vertices = np.array(hex.get_polygon(loop=True))
-        names = p['name'].split(' ')
-        name,  surname = names[0], names[-1]
-        initials = name[0] + surname[0]
-        ax.text(center[0] - 10, center[1] + 30, initials, color='grey', fontsize=16, 
-                ha='center', va='center', fontweight='bold', font="Courier")
-        ax.fill(vertices[:, 0], vertices[:, 1], color='gainsboro', zorder=0)
-
-
-def draw_corner_aruco(ax):
-    # add aruco to corners
-    plot_aruco(0, pd, header_size + pd, corner_aruco_size, ax=ax)
-    plot_aruco(1, w - pd - corner_aruco_size, header_size + pd, corner_aruco_size, ax=ax)
-    plot_aruco(2, pd, h - pd - corner_aruco_size, corner_aruco_size, ax=ax)
-    plot_aruco(3, w - pd - corner_aruco_size, h - pd - corner_aruco_size, corner_aruco_size, ax=ax)
-
-
-def sanitise_figure(fig):
-    ax = fig.gca()
-    # pull plots on the A4 size page
-    ax.set_position([0, 0, 1, 1])
-    ax.set_xlim(0, w * pf)
-    ax.set_ylim(0, h * pf)
-    ax.invert_yaxis()
-    ax.axis('off')
-    ax.set_axis_off()
-
-    fig.subplots_adjust(top=1, bottom=0, right=1, left=0,
-                        hspace=0, wspace=0)
-    ax.margins(0, 0)
-    ax.xaxis.set_major_locator(plt.NullLocator())
-    ax.yaxis.set_major_locator(plt.NullLocator())
+FONTS_DIR = Path(__file__).parent / 'fonts'
 
 
-class PDF(FPDF, HTMLMixin):
-    pass
+@lru_cache(maxsize=1)
+def fpdf_fonts():
+    """
+    Document with the fonts of the sheet loaded and nothing drawn, parsed once per
+    process. ``get_fpdf_page`` copies the fonts from it.
+    """
+    fpdf = PDF()
+    fpdf.add_font("Futura PT", fname=FONTS_DIR / 'FuturaPTBook.ttf')
+    fpdf.add_font("Futura PT", style='I', fname=FONTS_DIR / 'FuturaPTBookOblique.ttf')
+    fpdf.add_font("Futura PT", style='B', fname=FONTS_DIR / 'FuturaPTHeavy.ttf')
+    return fpdf
 
 
 def get_fpdf_page():
     fpdf = PDF()
     fpdf.add_page()
-    fpdf.add_font("Futura PT", fname=r'./fonts/FuturaPTBook.ttf')
-    fpdf.add_font("Futura PT", style='I', fname=r'./fonts/FuturaPTBookOblique.ttf')
-    fpdf.add_font("Futura PT", style='B', fname=r'./fonts/FuturaPTHeavy.ttf')
+
+    # the parsed metrics are shared, only the sets of used glyphs (embedded on
+    # output) belong to the document
+    fonts = fpdf_fonts()
+    for fontkey, font in fonts.fonts.items():
+        fpdf.fonts[fontkey] = {**font, "subset": copy.deepcopy(font["subset"])}
+        fpdf.font_files[fontkey] = dict(fonts.font_files[fontkey])
+
     return fpdf
 
 
@@ -188,36 +127,102 @@ def draw_qr(fpdf, qr_string):
                w=45, h=45)
 
 
-def renger_field(config, output_name):
-    fig = plt.figure(figsize=(8.27, 11.69))
-    ax = fig.gca()
+@lru_cache(maxsize=8)
+def grid_path(orientation='pointy', grid_size=5) -> str:
+    """
+    PDF path operators of all the edges of the hex grid of the sheet on an A4 page,
+    each edge once (neighbouring hexagons share them). Built once per grid.
+    """
+    polygons = sheet_grid(grid_size=grid_size, orientation=orientation).get_polygons() / pf
+    edges = np.round(np.concatenate([polygons, np.roll(polygons, -1, axis=1)], axis=2).reshape(-1, 4), 3)
+
+    flipped = (edges[:, 0] > edges[:, 2]) | ((edges[:, 0] == edges[:, 2]) & (edges[:, 1] > edges[:, 3]))
+    edges[flipped] = edges[flipped][:, [2, 3, 0, 1]]
+    edges = np.unique(edges, axis=0)
+
+    # PDF user space: points, from the bottom left corner
+    edges[:, [0, 2]] *= pt
+    edges[:, [1, 3]] = (h - edges[:, [1, 3]]) * pt
+
+    return "\n".join(f"{x1:.2f} {y1:.2f} m {x2:.2f} {y2:.2f} l" for x1, y1, x2, y2 in edges.tolist()) + "\nS"
+
+
+def stroke_grid(fpdf, orientation='pointy', grid_size=5):
+    fpdf.set_draw_color(220, 220, 220)  # gainsboro
+    fpdf.set_line_width(1.5 / fpdf.k)  # 1.5 pt
+    # one path for the whole grid; round caps and joins close the corners where the
+    # separate edges meet
+    fpdf._out("q 1 J 1 j")
+    fpdf._out(grid_path(orientation, grid_size))
+    fpdf._out("Q")
+
+
+def fill_aruco(fpdf, i, x, y, size):
+    """
+    Draws the ArUco marker ``i`` as one path of black rectangles, ``x``, ``y`` and
+    ``size`` in mm.
+    """
+    cells, runs = aruco_runs(i)
+    cell = size / cells
+
+    fpdf.set_fill_color(0, 0, 0)
+    fpdf._out("\n".join(f"{(x + column * cell) * fpdf.k:.3f} {(fpdf.h - y - row * cell) * fpdf.k:.3f} "
+                         f"{length * cell * fpdf.k:.3f} {-cell * fpdf.k:.3f} re"
+                         for row, column, length in runs) + "\nf")
+
+
+def fill_corner_aruco(fpdf):
+    fill_aruco(fpdf, 0, pd, header_size + pd, corner_aruco_size)
+    fill_aruco(fpdf, 1, w - pd - corner_aruco_size, header_size + pd, corner_aruco_size)
+    fill_aruco(fpdf, 2, pd, h - pd - corner_aruco_size, corner_aruco_size)
+    fill_aruco(fpdf, 3, w - pd - corner_aruco_size, h - pd - corner_aruco_size, corner_aruco_size)
+
+
+def fill_start_hexes(fpdf, hex_grid, players):
+    fpdf.set_fill_color(220, 220, 220)  # gainsboro, same as the grid lines
+    for p in players:
+        hex = hex_grid[p['coords'][0], p['coords'][1]]
+        fpdf.polygon([(x / pf, y / pf) for x, y in hex.get_polygon()], style='F')
+
+
+def write_initials(fpdf, hex_grid, players):
+    fpdf.set_text_color(128, 128, 128)
+    fpdf.set_font("courier", style='B', size=16)
+
+    for p in players:
+        hex = hex_grid[p['coords'][0], p['coords'][1]]
+        names = p['name'].split(' ')
+        initials = names[0][0] + names[-1][0]
+        center = hex.get_center()
+        # centered on the hexagon, slightly below it, as the cap height is ~0.6 em
+        fpdf.text((center[0] - 10) / pf - fpdf.get_string_width(initials) / 2,
+                  (center[1] + 30) / pf + 0.3 * fpdf.font_size, initials)
 
-    hex_grid = create_hex_grid(grid_size=config['grid_size'], orientation=config['orientation'], ax=ax)
-    draw_initials(hex_grid, players=config['players'], ax=ax)
-    draw_corner_aruco(ax)
-    sanitise_figure(fig)
-    fig.savefig(output_name, bbox_inches='tight', pad_inches=0.0)
-    plt.close()
 
+def render_sheet(config, qr_string) -> bytes:
+    """
+    Renders the game sheet as vector graphics straight into a single FPDF document.
 
-def create_text_and_merge(qr_string, output_name):
+    Returns
+    -------
+    PDF file content
+    """
     fpdf = get_fpdf_page()
     add_text(fpdf)
     draw_qr(fpdf, qr_string)
 
-    pdf_with_text = PdfReader(fdata=bytes(fpdf.output())).pages[0]
-
-    pdf_field = PdfReader(output_name)
-    pdf_merged = PdfWriter()
-    pdf_merged.addpage(pdf_field.pages[0])
+    hex_grid = sheet_grid(grid_size=config['grid_size'], orientation=config['orientation'])
+    fill_start_hexes(fpdf, hex_grid, config['players'])
+    stroke_grid(fpdf, orientation=config['orientation'], grid_size=config['grid_size'])
+    write_initials(fpdf, hex_grid, config['players'])
+    fill_corner_aruco(fpdf)
 
-    PageMerge(pdf_merged.pagearray[0]).add(pdf_with_text, prepend=False).render()
-    pdf_merged.write(output_name)
+    return bytes(fpdf.output())
 
 
 def render_page(config, qr_string, output_name='documents/game_field.pdf'):
-    renger_field(config, output_name)
-    create_text_and_merge(qr_string, output_name)
+    with open(output_name, 'wb') as f:
+        f.write(render_sheet(config, qr_string))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,302 @@
+import hashlib
+import os
+import queue
+import re
+import secrets
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+KEY_PATTERN = re.compile(r'^[a-z]+/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.[a-z0-9]+)?$')
+
+
+class LocalStorage:
+    """
+    Content-addressed blob storage on the local filesystem.
+
+    A blob is stored once, under the SHA-256 of its content:
+    ``<root>/<namespace>/<2 hex>/<2 hex>/<sha256><extension>``. The path relative to
+    the root is the key of the blob, the hash is its ETag. A key can also be reserved
+    before the blob exists (``reserve_key``), it is random then and the blob stored
+    under it never changes either. Until the blob is stored the key is pending: a
+    ``<blob path>.pending`` marker, visible to every process sharing the storage.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the storage, created if missing
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def make_key(data: bytes, namespace, extension=''):
+        digest = hashlib.sha256(data).hexdigest()
+        return f"{namespace}/{digest[:2]}/{digest[2:4]}/{digest}{extension.lower()}"
+
+    def reserve_key(self, namespace, extension=''):
+        digest = secrets.token_hex(32)
+        key = f"{namespace}/{digest[:2]}/{digest[2:4]}/{digest}{extension.lower()}"
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path + '.pending', 'wb').close()
+
+        return key
+
+    def is_pending(self, key):
+        path = self.path(key)
+        return path is not None and os.path.exists(path + '.pending')
+
+    def release(self, key):
+        """
+        Removes the pending marker of the reserved key, when its blob is stored or
+        will never be.
+        """
+        try:
+            os.remove(self.path(key) + '.pending')
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def etag(key):
+        return os.path.splitext(os.path.basename(key))[0]
+
+    def path(self, key):
+        """
+        Path of the blob, None for a malformed key.
+        """
+        if not KEY_PATTERN.match(key):
+            return None
+
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        path = self.path(key)
+        return path is not None and os.path.exists(path)
+
+    def wait(self, key, timeout, interval=0.1):
+        """
+        Polls until the blob exists, for at most ``timeout`` seconds, while its key is
+        pending.
+
+        Returns
+        -------
+        Whether the blob exists
+        """
+        deadline = time.monotonic() + timeout
+        while not self.exists(key):
+            if not self.is_pending(key) or time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    def put(self, data: bytes, namespace, extension='', key=None) -> str:
+        """
+        Stores the blob unless the same content is already stored, under ``key`` if
+        it is given (e.g. reserved by ``reserve_key``, which is released then).
+
+        Returns
+        -------
+        Key of the blob
+        """
+        key_given = key is not None
+        key = key or self.make_key(data, namespace, extension)
+        path = self.path(key)
+
+        if os.path.exists(path):
+            # storing it again renews it for the garbage collection
+            os.utime(path)
+            if key_given:
+                self.release(key)
+            return key
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        if key_given:
+            self.release(key)
+
+        return key
+
+    def get(self, key) -> bytes:
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def collect_garbage(self, namespace, ttl):
+        """
+        Removes the blobs of the namespace stored more than ``ttl`` seconds ago.
+
+        Returns
+        -------
+        Number of the removed blobs
+        """
+        expired = time.time() - ttl
+        removed = 0
+
+        for directory, _, files in os.walk(os.path.join(self.root, namespace)):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < expired:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+
+        return removed
+
+    def start_collector(self, namespace, ttl, interval=3600):
+        """
+        Runs ``collect_garbage`` for the namespace every ``interval`` seconds on a
+        daemon thread.
+        """
+        def collect():
+            while True:
+                removed = self.collect_garbage(namespace, ttl)
+                if removed:
+                    print(f"Storage: {removed} expired blobs removed from {namespace}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=collect, name=f'storage-gc-{namespace}', daemon=True)
+        thread.start()
+        return thread
+
+
+class BackgroundWriter:
+    """
+    Bounded pool of threads persisting the results of the uploads after the response
+    is sent: blobs to the ``storage`` and rows to the database.
+
+    Blob writes are submitted with their key known in advance (content hash or
+    reserved key), so the url can be returned before the blob exists. Rows are
+    collected and passed to ``insert_rows`` in batches of up to ``batch_size``, or
+    whatever arrived within ``flush_interval`` seconds.
+
+    ``submit`` and ``add_row`` block while ``max_pending`` writes or rows are waiting,
+    slowing the uploads down instead of dropping anything. ``flush`` waits until
+    everything submitted is persisted, ``shutdown`` flushes and stops the threads.
+
+    Parameters
+    ----------
+    storage : LocalStorage
+    insert_rows : callable
+        Called with a list of rows on the inserting thread
+    workers : int
+        Number of writing threads
+    """
+
+    def __init__(self, storage, insert_rows=None, workers=2, max_pending=32, batch_size=32, flush_interval=1.0):
+        self.storage = storage
+        self.insert_rows = insert_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._futures = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='writer')
+
+        self._rows = queue.Queue(maxsize=max_pending)
+        self._inserter = threading.Thread(target=self._insert_rows, name='writer-rows', daemon=True)
+        self._inserter.start()
+
+    def submit(self, key, fn, *args):
+        """
+        Runs ``fn(*args)`` on a writing thread, ``fn`` must store the blob under
+        ``key``.
+        """
+        self._slots.acquire()
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._pending[key] = future
+            self._futures.add(future)
+        future.add_done_callback(lambda f: self._done(key, f))
+
+        return future
+
+    def put(self, key, data: bytes, row=None):
+        """
+        Stores the blob under ``key`` in the background, then adds the ``row``.
+        """
+        def write():
+            self.storage.put(data, None, key=key)
+            if row is not None:
+                self.add_row(row)
+
+        return self.submit(key, write)
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+            self._futures.discard(future)
+        self._slots.release()
+
+        if future.exception() is not None:
+            print(f"Writer: can't store {key}: {future.exception()}")
+
+    def wait(self, key, timeout=None):
+        """
+        Waits until the pending write of the blob finishes, returns immediately if
+        there is none.
+        """
+        with self._lock:
+            future = self._pending.get(key)
+
+        if future is not None:
+            wait([future], timeout=timeout)
+
+    def add_row(self, row):
+        self._rows.put(row)
+
+    def _insert_rows(self):
+        while True:
+            rows = [self._rows.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self._rows.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            try:
+                if self.insert_rows is not None:
+                    self.insert_rows(rows)
+            except Exception as e:
+                print(f"Writer: can't insert {len(rows)} rows: {e}")
+            finally:
+                for _ in rows:
+                    self._rows.task_done()
+
+    def flush(self):
+        """
+        Waits until every submitted blob and row is persisted.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+        self._rows.join()
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown(wait=True)